@@ -0,0 +1,230 @@
+# Offline benchmark and regression check of the MiHome ingest module.
+# Runs MiHomeIngestModule.process over synthetic SharedPreferences files, against the fakes of fake_autopsy,
+# and reports throughput, peak memory and blackboard calls per artifact.
+#
+# Usage (Python 2.7, from any directory):
+#   python bench_mi_home.py --events 200000
+#   python bench_mi_home.py --events 200000 --save-baseline baseline.json
+#   python bench_mi_home.py --events 200000 --baseline baseline.json
+#   python bench_mi_home.py --events 200000 --files 8 --workers 4 --file-pipeline
+# With --baseline the exit status is 1 if any metric regressed by more than the tolerance.
+
+import argparse
+import gc
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fake_autopsy
+fake_autopsy.install()
+
+import generate
+import mi_home
+
+SHARED_PREFS = "/data/data/com.xiaomi.smarthome/shared_prefs/"
+
+# Absolute memory growth always allowed, small runs are dominated by allocator noise
+MEMORY_SLACK_MB = 5.0
+
+BLACKBOARD_CALLS = ("getOrAddArtifactType", "getOrAddAttributeType", "postArtifact", "postArtifacts",
+                    "newArtifact", "addAttribute", "addAttributes")
+
+
+# Swallows the output of the module while it runs
+class NullOutput(object):
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+# Samples the resident memory of the process while the module runs, peak is reported relative to the start.
+# Uses /proc/self/statm where available, the process high-water mark otherwise.
+class MemorySampler(object):
+    interval = 0.01
+
+    def __init__(self):
+        self.start_mb = self.current_mb()
+        self.peak_mb = self.start_mb
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.setDaemon(True)
+
+    def current_mb(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+        except (IOError, OSError, ValueError):
+            pass
+        if resource is None:
+            return 0.0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+    def sample(self):
+        while not self.stopped.isSet():
+            self.peak_mb = max(self.peak_mb, self.current_mb())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_mb = max(self.peak_mb, self.current_mb())
+
+    def growth_mb(self):
+        return max(0.0, self.peak_mb - self.start_mb)
+
+
+def build_files(args):
+    files = [fake_autopsy.AbstractFile("home_room_manager_sp_.xml", SHARED_PREFS,
+                                       generate.generate_room_manager(seed=args.seed)),
+             fake_autopsy.AbstractFile("home_env_info.xml", SHARED_PREFS, generate.generate_env_info(seed=args.seed))]
+    for i in range(args.files):
+        content = generate.generate_config(args.events // args.files, args.devices, seed=args.seed + i)
+        files.append(fake_autopsy.AbstractFile("config.xml", SHARED_PREFS, content))
+    return files
+
+
+# Runs the file ingest modules the way the Autopsy file pipeline does: one module per thread, every file handed
+# to the next free thread
+def process_files(settings, files, num_threads):
+    context = fake_autopsy.IngestJobContext()
+    modules = [mi_home.MiHomeFileIngestModule(settings) for _ in range(max(1, num_threads))]
+    pending = Queue.Queue()
+    for file in files:
+        pending.put(file)
+
+    def work(module):
+        while True:
+            try:
+                file = pending.get_nowait()
+            except Queue.Empty:
+                return
+            module.process(file)
+
+    for module in modules:
+        module.startUp(context)
+    threads = [threading.Thread(target=work, args=(module,)) for module in modules]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for module in modules:
+        module.shutDown()
+    return fake_autopsy.IngestModule.ProcessResult.OK
+
+
+def run(args):
+    files = build_files(args)
+    case = fake_autopsy.Case(files)
+    fake_autopsy.Case.current = case
+    fake_autopsy.counters.reset()
+
+    settings = mi_home.MiHomeIngestModuleSettings()
+    settings.set_streaming_parse(not args.no_streaming)
+    settings.set_batch_size(args.batch_size)
+    settings.set_worker_threads(args.workers)
+    settings.set_file_pipeline(args.file_pipeline)
+    # Every run starts from an empty case, the index would only add disk writes
+    settings.set_incremental(False)
+
+    gc.collect()
+    stdout, sys.stdout = sys.stdout, NullOutput()
+    try:
+        with MemorySampler() as memory:
+            start = time.time()
+            if args.file_pipeline:
+                result = process_files(settings, files, args.workers)
+            else:
+                module = mi_home.MiHomeIngestModule(settings)
+                module.startUp(fake_autopsy.IngestJobContext())
+                result = module.process(fake_autopsy.DataSource(1), fake_autopsy.DataSourceIngestModuleProgress())
+            elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+        case.close()
+
+    artifacts = case.getSleuthkitCase().getBlackboard().posted_count
+    calls = fake_autopsy.counters.total(*BLACKBOARD_CALLS)
+    return {
+        "result": result,
+        "input_mb": sum(file.getSize() for file in files) / (1024.0 * 1024.0),
+        "artifacts": artifacts,
+        "seconds": elapsed,
+        "artifacts_per_sec": artifacts / elapsed if elapsed else 0.0,
+        "peak_memory_mb": memory.growth_mb(),
+        "blackboard_calls": calls,
+        "blackboard_calls_per_artifact": float(calls) / artifacts if artifacts else 0.0,
+    }
+
+
+# Returns the metrics that regressed by more than the tolerance against the baseline
+def check(metrics, baseline, tolerance):
+    failures = []
+    if metrics["artifacts_per_sec"] < baseline["artifacts_per_sec"] * (1 - tolerance):
+        failures.append("artifacts_per_sec")
+    if metrics["peak_memory_mb"] > baseline["peak_memory_mb"] * (1 + tolerance) + MEMORY_SLACK_MB:
+        failures.append("peak_memory_mb")
+    # Deterministic, no tolerance
+    if metrics["blackboard_calls_per_artifact"] > baseline["blackboard_calls_per_artifact"] + 1e-9:
+        failures.append("blackboard_calls_per_artifact")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the MiHome ingest module against fake Autopsy APIs")
+    parser.add_argument("--events", type=int, default=100000, help="events generated across all config.xml files")
+    parser.add_argument("--files", type=int, default=1, help="number of config.xml files")
+    parser.add_argument("--devices", type=int, default=4, help="devices per config.xml file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="parser threads, or pipeline threads with --file-pipeline")
+    parser.add_argument("--file-pipeline", action="store_true", help="run the file ingest module instead")
+    parser.add_argument("--no-streaming", action="store_true", help="load the whole DOM and JSON values at once")
+    parser.add_argument("--baseline", help="JSON file of reference metrics to check against")
+    parser.add_argument("--save-baseline", help="write the metrics of this run to the given JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative regression (default: 0.3)")
+    args = parser.parse_args()
+
+    metrics = run(args)
+    for name in ("result", "input_mb", "artifacts", "seconds", "artifacts_per_sec", "peak_memory_mb",
+                 "blackboard_calls", "blackboard_calls_per_artifact"):
+        value = metrics[name]
+        print("%-30s %s" % (name, "%.3f" % value if isinstance(value, float) else value))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(metrics, baseline_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            failures = check(metrics, json.load(baseline_file), args.tolerance)
+        if failures:
+            print("REGRESSION: " + ", ".join(failures))
+            return 1
+        print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,587 @@
+# Lightweight stand-ins for the Java and Autopsy APIs used by mi_home.py.
+# install() registers them as the java.*, javax.*, jarray and org.sleuthkit.* modules, so that the plugin
+# can be imported and run by a plain Python 2.7 interpreter, without Autopsy nor a phone image.
+# Blackboard and file operations are counted to measure the case DB traffic generated by the module.
+
+import array
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+
+# Counters shared by all the fakes, reset for every benchmark run
+class Counters(object):
+
+    def __init__(self):
+        self.calls = {}
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def total(self, *names):
+        return sum(self.calls.get(name, 0) for name in names)
+
+    def reset(self):
+        self.calls = {}
+
+
+counters = Counters()
+
+
+# java.lang / java.util / java.util.logging
+
+class IllegalArgumentException(Exception):
+    pass
+
+
+class System(object):
+
+    @staticmethod
+    def nanoTime():
+        return int(time.time() * 1000000000)
+
+
+class JavaClass(object):
+
+    @staticmethod
+    def forName(name):
+        return JavaClass
+
+    @staticmethod
+    def newInstance():
+        return None
+
+
+class Runtime(object):
+
+    @staticmethod
+    def getRuntime():
+        return Runtime
+
+    @staticmethod
+    def availableProcessors():
+        return 4
+
+
+class ArrayList(list):
+
+    def add(self, item):
+        self.append(item)
+
+    def size(self):
+        return len(self)
+
+    def isEmpty(self):
+        return len(self) == 0
+
+
+class Level(object):
+    SEVERE = "SEVERE"
+    WARNING = "WARNING"
+    INFO = "INFO"
+    CONFIG = "CONFIG"
+    FINE = "FINE"
+    FINER = "FINER"
+    FINEST = "FINEST"
+
+    _order = (SEVERE, WARNING, INFO, CONFIG, FINE, FINER, FINEST)
+
+
+class File(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+# java.nio.file, paths are plain strings
+
+class Paths(object):
+
+    @staticmethod
+    def get(path):
+        return path
+
+
+class StandardCopyOption(object):
+    REPLACE_EXISTING = "REPLACE_EXISTING"
+    ATOMIC_MOVE = "ATOMIC_MOVE"
+
+
+class Files(object):
+
+    @staticmethod
+    def move(source, target, *options):
+        os.rename(source, target)
+        return target
+
+
+# java.sql, backed by sqlite3 so that miio.db files can be benchmarked too
+
+class ResultSet(object):
+    TYPE_FORWARD_ONLY = 1003
+    CONCUR_READ_ONLY = 1007
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.row = None
+
+    def next(self):
+        self.row = self.cursor.fetchone()
+        return self.row is not None
+
+    def getString(self, index):
+        value = self.row[index - 1]
+        return None if value is None else unicode(value)
+
+    def close(self):
+        self.cursor.close()
+
+
+class Statement(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def setFetchSize(self, size):
+        pass
+
+    def executeQuery(self, query):
+        return ResultSet(self.connection.execute(query))
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+
+    def createStatement(self, *args):
+        return Statement(self.connection)
+
+    def close(self):
+        self.connection.close()
+
+
+class DriverManager(object):
+
+    @staticmethod
+    def getConnection(url):
+        return Connection(url[len("jdbc:sqlite:"):])
+
+
+# org.sleuthkit.datamodel
+
+class AttributeType(object):
+
+    def __init__(self, type_name, value_type, display_name):
+        self.type_name = type_name
+        self.value_type = value_type
+        self.display_name = display_name
+
+    def getTypeName(self):
+        return self.type_name
+
+
+class ArtifactType(object):
+
+    def __init__(self, type_id, type_name, display_name):
+        self.type_id = type_id
+        self.type_name = type_name
+        self.display_name = display_name
+
+    def getTypeID(self):
+        return self.type_id
+
+    def getTypeName(self):
+        return self.type_name
+
+
+class BlackboardAttribute(object):
+
+    class TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE(object):
+        STRING = "STRING"
+        INTEGER = "INTEGER"
+        LONG = "LONG"
+        DOUBLE = "DOUBLE"
+        DATETIME = "DATETIME"
+
+    class ATTRIBUTE_TYPE(object):
+        TSK_SET_NAME = AttributeType("TSK_SET_NAME", "STRING", "Set Name")
+
+    def __init__(self, attribute_type, source, value):
+        self.attribute_type = attribute_type
+        self.source = source
+        self.value = value
+
+    def getAttributeType(self):
+        return self.attribute_type
+
+    def getDisplayString(self):
+        return unicode(self.value)
+
+
+class BlackboardArtifact(object):
+
+    class ARTIFACT_TYPE(object):
+        TSK_INTERESTING_FILE_HIT = "TSK_INTERESTING_FILE_HIT"
+
+    def __init__(self, file, type_id):
+        self.file = file
+        self.type_id = type_id
+        self.attributes = []
+
+    def getArtifactTypeID(self):
+        return self.type_id
+
+    def getAttributes(self):
+        return self.attributes
+
+    def addAttribute(self, attribute):
+        counters.count("addAttribute")
+        self.attributes.append(attribute)
+
+    def addAttributes(self, attributes):
+        counters.count("addAttributes")
+        self.attributes.extend(attributes)
+
+
+class Blackboard(object):
+
+    def __init__(self, keep_artifacts):
+        self.keep_artifacts = keep_artifacts
+        self.artifact_types = {}
+        self.attribute_types = {}
+        self.posted = []
+        self.posted_count = 0
+
+    def getOrAddArtifactType(self, type_name, display_name):
+        counters.count("getOrAddArtifactType")
+        if type_name not in self.artifact_types:
+            self.artifact_types[type_name] = ArtifactType(10000 + len(self.artifact_types), type_name, display_name)
+        return self.artifact_types[type_name]
+
+    def getOrAddAttributeType(self, type_name, value_type, display_name):
+        counters.count("getOrAddAttributeType")
+        if type_name not in self.attribute_types:
+            self.attribute_types[type_name] = AttributeType(type_name, value_type, display_name)
+        return self.attribute_types[type_name]
+
+    def postArtifact(self, artifact, module_name):
+        counters.count("postArtifact")
+        self.post([artifact])
+
+    def postArtifacts(self, artifacts, module_name):
+        counters.count("postArtifacts")
+        self.post(artifacts)
+
+    def post(self, artifacts):
+        self.posted_count += len(artifacts)
+        if self.keep_artifacts:
+            self.posted.extend(artifacts)
+
+
+class AbstractFile(object):
+    _next_id = [1]
+
+    def __init__(self, name, parent_path, content, data_source_obj_id=1):
+        self.data_source_obj_id = data_source_obj_id
+        self.id = AbstractFile._next_id[0]
+        AbstractFile._next_id[0] += 1
+        self.name = name
+        self.parent_path = parent_path
+        self.content = content
+        self.mtime = 1500000000
+        self.md5 = None
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+    def getDataSource(self):
+        return DataSource(self.data_source_obj_id)
+
+    def getParentPath(self):
+        return self.parent_path
+
+    def getUniquePath(self):
+        return self.parent_path + self.name
+
+    def getSize(self):
+        return len(self.content)
+
+    def getMtime(self):
+        return self.mtime
+
+    def getMd5Hash(self):
+        return self.md5
+
+    def isFile(self):
+        return True
+
+    def isDir(self):
+        return False
+
+    def read(self, buf, offset, length):
+        counters.count("read")
+        chunk = self.content[offset:offset + length]
+        buf[:len(chunk)] = array.array("b", chunk)
+        return len(chunk)
+
+    def newArtifact(self, type_id):
+        counters.count("newArtifact")
+        return BlackboardArtifact(self, type_id)
+
+
+class ReadContentInputStream(object):
+
+    def __init__(self, file):
+        self.file = file
+        self.position = 0
+
+    def read(self, buf, offset=0, length=None):
+        counters.count("read")
+        if length is None:
+            length = len(buf)
+        chunk = self.file.content[self.position:self.position + length]
+        if not chunk:
+            return -1
+        buf[offset:offset + len(chunk)] = array.array("b", chunk)
+        self.position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+# Stand-in for the data source Content passed to the ingest module
+class DataSource(object):
+
+    def __init__(self, obj_id):
+        self.obj_id = obj_id
+
+    def getId(self):
+        return self.obj_id
+
+
+class SleuthkitCase(object):
+
+    def __init__(self, files, keep_artifacts):
+        self.files = dict((file.getId(), file) for file in files)
+        self.blackboard = Blackboard(keep_artifacts)
+        # In-memory copy of the columns of tsk_files queried by the module
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.db.execute("CREATE TABLE tsk_files (obj_id INTEGER, data_source_obj_id INTEGER, name TEXT, parent_path TEXT)")
+        self.db.executemany("INSERT INTO tsk_files VALUES (?, ?, ?, ?)",
+                            [(file.getId(), file.data_source_obj_id, file.getName(), file.getParentPath())
+                             for file in files])
+
+    def getBlackboard(self):
+        return self.blackboard
+
+    def findAllFilesWhere(self, where):
+        counters.count("findAllFilesWhere")
+        rows = self.db.execute("SELECT obj_id FROM tsk_files WHERE " + where + " ORDER BY obj_id")
+        return [self.files[obj_id] for obj_id, in rows]
+
+
+# org.sleuthkit.autopsy.*
+
+class Logger(object):
+    records = []
+    level = Level.INFO
+
+    @classmethod
+    def getLogger(cls, name):
+        return cls()
+
+    def isLoggable(self, level):
+        return Level._order.index(level) <= Level._order.index(Logger.level)
+
+    def logp(self, level, source_class, source_method, msg):
+        Logger.records.append((level, source_class, source_method, msg))
+
+
+class FileManager(object):
+
+    def __init__(self, files):
+        self.files = files
+
+    # Same matching as the Autopsy FileManager: exact name, parent path containing the given substring
+    def findFiles(self, data_source, name, parent_substring=None):
+        counters.count("findFiles")
+        return [file for file in self.files
+                if file.getName() == name and (parent_substring is None or parent_substring in file.getParentPath())]
+
+
+class Services(object):
+
+    def __init__(self, files):
+        self.file_manager = FileManager(files)
+
+    def getFileManager(self):
+        return self.file_manager
+
+
+class Case(object):
+    current = None
+
+    def __init__(self, files, keep_artifacts=False):
+        self.sleuthkit_case = SleuthkitCase(files, keep_artifacts)
+        self.services = Services(files)
+        self.directory = tempfile.mkdtemp(prefix="mihome_bench_")
+        os.makedirs(os.path.join(self.directory, "Temp"))
+        os.makedirs(os.path.join(self.directory, "ModuleOutput"))
+
+    @classmethod
+    def getCurrentCase(cls):
+        return cls.current
+
+    def getSleuthkitCase(self):
+        return self.sleuthkit_case
+
+    def getServices(self):
+        return self.services
+
+    def getTempDirectory(self):
+        return os.path.join(self.directory, "Temp")
+
+    def getModuleDirectory(self):
+        return os.path.join(self.directory, "ModuleOutput")
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ContentUtils(object):
+
+    @staticmethod
+    def writeToFile(file, local_file):
+        counters.count("writeToFile")
+        with open(local_file.path, "wb") as output:
+            output.write(file.content)
+
+
+class IngestModuleException(Exception):
+    pass
+
+
+class IngestModule(object):
+
+    class ProcessResult(object):
+        OK = "OK"
+        ERROR = "ERROR"
+
+
+class IngestMessage(object):
+
+    class MessageType(object):
+        DATA = "DATA"
+        INFO = "INFO"
+        WARNING = "WARNING"
+        ERROR = "ERROR"
+
+    @staticmethod
+    def createMessage(message_type, source, subject, details=None):
+        return (message_type, source, subject, details)
+
+
+class IngestServices(object):
+    messages = []
+    _instance = None
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def postMessage(self, message):
+        IngestServices.messages.append(message)
+
+
+# Stand-in for org.sleuthkit.autopsy.ingest.IngestJobContext
+class IngestJobContext(object):
+
+    def __init__(self):
+        self.cancelled = False
+
+    def getJobId(self):
+        return 1
+
+    def isJobCancelled(self):
+        return self.cancelled
+
+    def dataSourceIngestIsCancelled(self):
+        return self.cancelled
+
+    def fileIngestIsCancelled(self):
+        return self.cancelled
+
+
+# Stand-in for org.sleuthkit.autopsy.ingest.DataSourceIngestModuleProgress
+class DataSourceIngestModuleProgress(object):
+
+    def __init__(self):
+        self.updates = 0
+
+    def switchToIndeterminate(self):
+        pass
+
+    def switchToDeterminate(self, work_units):
+        pass
+
+    def progress(self, *args):
+        self.updates += 1
+
+
+# Base class for the Java interfaces and adapters the plugin extends
+class JavaInterface(object):
+    pass
+
+
+def _module(name, **members):
+    module = types.ModuleType(name)
+    module.__dict__.update(members)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent:
+        if parent not in sys.modules:
+            _module(parent)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# Registers the fakes in place of the Java packages imported by the plugin
+def install():
+    _module("jarray",
+            zeros=lambda length, type_code: array.array(type_code, [0]) * length,
+            array=lambda sequence, type_code: array.array(type_code, sequence))
+    _module("java.lang", System=System, Class=JavaClass, Runtime=Runtime,
+            IllegalArgumentException=IllegalArgumentException)
+    _module("java.util", ArrayList=ArrayList)
+    _module("java.util.logging", Level=Level)
+    _module("java.io", File=File)
+    _module("java.nio.file", Files=Files, Paths=Paths, StandardCopyOption=StandardCopyOption)
+    _module("java.sql", DriverManager=DriverManager, SQLException=sqlite3.Error, ResultSet=ResultSet)
+    _module("javax.swing", JCheckBox=JavaInterface, BoxLayout=JavaInterface, JLabel=JavaInterface,
+            JPanel=JavaInterface, JSpinner=JavaInterface, SpinnerNumberModel=JavaInterface)
+    _module("org.sleuthkit.datamodel", SleuthkitCase=SleuthkitCase, AbstractFile=AbstractFile,
+            ReadContentInputStream=ReadContentInputStream, BlackboardArtifact=BlackboardArtifact,
+            BlackboardAttribute=BlackboardAttribute)
+    _module("org.sleuthkit.autopsy.ingest", IngestModule=IngestModule, DataSourceIngestModule=JavaInterface,
+            FileIngestModule=JavaInterface, IngestModuleFactoryAdapter=JavaInterface,
+            IngestModuleIngestJobSettings=JavaInterface, IngestModuleIngestJobSettingsPanel=JavaInterface,
+            IngestMessage=IngestMessage, IngestServices=IngestServices, ModuleDataEvent=JavaInterface)
+    _module("org.sleuthkit.autopsy.ingest.IngestModule", IngestModuleException=IngestModuleException,
+            ProcessResult=IngestModule.ProcessResult)
+    _module("org.sleuthkit.autopsy.coreutils", Logger=Logger)
+    _module("org.sleuthkit.autopsy.casemodule", Case=Case)
+    _module("org.sleuthkit.autopsy.datamodel", ContentUtils=ContentUtils)
@@ -0,0 +1,85 @@
+# Synthetic Mi Home SharedPreferences files, laid out like the ones written by the app:
+# config.xml (Log_Normal and ht_stat device logs), home_env_info.xml and home_room_manager_sp_.xml.
+# Sizes are given in number of events, the content is deterministic for a given seed.
+
+import json
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+# Events per Log_Normal log entry, and readings per ht_stat value
+PAYLOADS_PER_LOG = 4
+READINGS = ("temperature", "humidity")
+
+BASE_TS = 1500000000
+
+
+def shared_prefs(entries):
+    lines = ["<?xml version='1.0' encoding='utf-8' standalone='yes' ?>", "<map>"]
+    for name, value in entries:
+        lines.append("    <string name=%s>%s</string>" % (quoteattr(name), escape(value)))
+    lines.append("</map>")
+    return "\n".join(lines) + "\n"
+
+
+def device_id(rng):
+    return "lumi.158d000%06x" % rng.randint(0, 0xffffff)
+
+
+# Log_Normal entry of a motion/door sensor, num_events events spread over logs of PAYLOADS_PER_LOG payloads
+def log_normal(rng, device, num_events):
+    logs = []
+    ts = BASE_TS
+    while num_events > 0:
+        payloads = []
+        for _ in range(min(PAYLOADS_PER_LOG, num_events)):
+            ts += rng.randint(1, 600)
+            payloads.append(json.dumps([ts * 1000, [rng.choice(("event.motion", "event.open", "event.close")), ""]]))
+            num_events -= 1
+        logs.append({"did": device, "time": ts + rng.randint(1, 30), "type": "event", "key": "motion",
+                     "value": json.dumps(payloads)})
+    return json.dumps({"value": logs})
+
+
+# ht_stat entry of a temperature/humidity sensor, num_events readings
+def ht_stat(rng, num_events):
+    values = []
+    ts = BASE_TS
+    for _ in range(max(1, num_events // len(READINGS))):
+        ts += rng.randint(60, 900)
+        values.append({"time": ts, "temperature": str(rng.randint(150, 300)), "humidity": str(rng.randint(300, 700))})
+    return json.dumps({"time": ts + 60, "value": json.dumps(values)})
+
+
+def generate_config(num_events, num_devices=4, seed=0):
+    rng = random.Random(seed)
+    entries = [("miot_user_last_login_time", str(BASE_TS))]
+    per_device = max(1, num_events // (2 * num_devices))
+    for _ in range(num_devices):
+        entries.append((device_id(rng) + "_Log_Normal", log_normal(rng, device_id(rng), per_device)))
+        entries.append((device_id(rng) + "_ht_stat", ht_stat(rng, per_device)))
+    return shared_prefs(entries)
+
+
+def generate_env_info(num_devices=4, seed=0):
+    rng = random.Random(seed)
+    description_list = []
+    for _ in range(num_devices):
+        details = [{"prop": prop, "timestamp": BASE_TS + rng.randint(0, 86400), "description": str(rng.randint(0, 100))}
+                   for prop in ("temperature", "humidity", "pm25")]
+        description_list.append({"did": device_id(rng), "details": details})
+    # The app stores these JSON blobs HTML-escaped on top of the XML escaping
+    return shared_prefs([("env_data", escape(json.dumps({"description_list": description_list}, sort_keys=True),
+                                             {'"': "&quot;"}))])
+
+
+def generate_room_manager(num_homes=1, num_rooms=4, num_devices=4, seed=0):
+    rng = random.Random(seed)
+    homelist = []
+    for home in range(num_homes):
+        roomlist = [{"name": "Room %d" % room, "id": str(rng.randint(10 ** 8, 10 ** 9)),
+                     "dids": [device_id(rng) for _ in range(num_devices)]} for room in range(num_rooms)]
+        homelist.append({"name": "Home %d" % home, "id": str(rng.randint(10 ** 8, 10 ** 9)),
+                         "address": "Batochime, Lausanne", "latitude": 46.52, "longitude": 6.58,
+                         "roomlist": roomlist})
+    return shared_prefs([("home_room_content", escape(json.dumps({"homelist": homelist}, sort_keys=True),
+                                                      {'"': "&quot;"}))])
@@ -1,11 +1,13 @@
 import jarray
-import inspect
+import sys
 
-from java.lang import System, Class, IllegalArgumentException
+from java.lang import System, Class, IllegalArgumentException, Runtime
 from java.util.logging import Level
 from java.io import File
-from java.sql import DriverManager, SQLException
-from javax.swing import JCheckBox, BoxLayout
+from java.nio.file import Files, Paths, StandardCopyOption
+from java.sql import DriverManager, SQLException, ResultSet
+from java.util import ArrayList
+from javax.swing import JCheckBox, BoxLayout, JLabel, JPanel, JSpinner, SpinnerNumberModel
 
 from org.sleuthkit.datamodel import SleuthkitCase
 from org.sleuthkit.datamodel import AbstractFile
@@ -27,6 +29,12 @@ from org.sleuthkit.autopsy.casemodule import Case
 from org.sleuthkit.autopsy.datamodel import ContentUtils
 
 import os
+import array
+import threading
+import Queue
+import hashlib
+import struct
+from collections import OrderedDict
 from time import mktime
 from xml.dom import minidom
 import xml.etree.ElementTree as ET
@@ -36,6 +44,57 @@ import HTMLParser
 from datetime import datetime, timedelta
 
 
+# Size of the buffer used when reading file contents
+READ_BUFFER_SIZE = 64 * 1024
+
+# Files parsed by the module
+# Yes, Alerm, they have a typo in the file
+ROOM_MANAGER_FILE = "home_room_manager_sp_.xml"
+ENV_INFO_FILE = "home_env_info.xml"
+DEVICE_LOG_FILE = "config.xml"
+DB_FILE = "miio.db"
+
+# config.xml files outside of the MiHome app folder are only parsed if one of the markers appears in their first bytes
+MIHOME_PACKAGE = "com.xiaomi.smarthome"
+SNIFF_SIZE = 8 * 1024
+SNIFF_MARKERS = ("Log_Normal", "_ht_stat", "env_data", "home_room_content")
+
+# Record types produced by the parsers, each one maps to an add_* method of the ingest module
+RECORD_EVENT = "event"
+RECORD_HOME = "home"
+RECORD_DEVICE = "device"
+RECORD_DB_DEVICE = "db_device"
+
+# Number of event timestamps normalised at once
+TIMESTAMP_BATCH_SIZE = 256
+
+# Number of decoded Log_Normal event lists, and of distinct event and device strings, kept per file
+PAYLOAD_CACHE_SIZE = 1024
+STRING_POOL_SIZE = 4096
+
+# Default memory cap of the table of events already posted during a job, in megabytes
+DEDUP_MEMORY_MB = 16
+
+# Number of records between two cancellation checks, and two progress updates, while parsing a file
+PROGRESS_INTERVAL = 1000
+
+# Number of rows fetched at once from miio.db
+DB_FETCH_SIZE = 1000
+
+# Files written next to miio.db by SQLite: rows still in the write-ahead log or the rollback journal are only seen
+# if these are copied along with the DB. The shared memory index (-shm) is rebuilt by SQLite, it is only cleaned up.
+DB_SIDECAR_SUFFIXES = ("-wal", "-journal")
+DB_TEMP_SUFFIXES = ("-wal", "-journal", "-shm")
+
+# Columns extracted from the miio.db tables. The schema changes between app versions, tables are
+# therefore recognised by their columns rather than by name, and missing columns are read as NULL.
+# Devices: one row per paired device
+DB_DEVICE_KEYS = ("did", "model")
+DB_DEVICE_COLUMNS = ("did", "name", "model", "mac", "ip", "ssid", "latitude", "longitude")
+# Logs: one row per device event
+DB_LOG_KEYS = ("did", "time", "value")
+DB_LOG_COLUMNS = ("did", "time", "type", "key", "value")
+
 # Factory that defines the name and details of the module and allows Autopsy
 # to create instances of the modules that will do the analysis.
 class MiHomeIngestModuleFactory(IngestModuleFactoryAdapter):
@@ -73,19 +132,358 @@ class MiHomeIngestModuleFactory(IngestModuleFactoryAdapter):
         return True
 
     def createDataSourceIngestModule(self, ingestOptions):
-        return MiHomeIngestModule(self.settings)
+        return MiHomeIngestModule(ingestOptions)
+
+    # Both kinds of modules are created for every job, the settings of the job tell which one does the work
+    def isFileIngestModuleFactory(self):
+        return True
 
+    def createFileIngestModule(self, ingestOptions):
+        return MiHomeFileIngestModule(ingestOptions)
 
-# Data Source-level ingest module.  One gets created per data source.
-class MiHomeIngestModule(DataSourceIngestModule):
+
+# Parsing of the MiHome files and creation of their artifacts, shared by the data source and file ingest modules.
+# The state of the ingest job is kept in a MiHomeJobState, its members are copied on the module by attach.
+class MiHomeIngestParser(object):
     _logger = Logger.getLogger(MiHomeIngestModuleFactory.moduleName)
 
     def log(self, level, msg):
-        self._logger.logp(level, self.__class__.__name__, inspect.stack()[1][3], msg)
+        if self._logger.isLoggable(level):
+            self._logger.logp(level, self.__class__.__name__, sys._getframe(1).f_code.co_name, msg)
 
     def __init__(self, settings):
         self.context = None
         self.local_settings = settings
+        self.job = None
+        self.types = None
+        self.writer = None
+        self.index = None
+        self.dedup = None
+        self.timestamps = None
+        self.stats = None
+        self.progress = None
+
+    def attach(self, job):
+        self.job = job
+        self.types = job.types
+        self.writer = job.writer
+        self.index = job.index
+        self.dedup = job.dedup
+        self.timestamps = job.timestamps
+        self.stats = job.stats
+
+    # Returns the function yielding the records of a file, or None if the file is not one of the MiHome files
+    # parsed with the current settings. Same matching as MiHomeIngestModule.find_files.
+    def reader(self, file):
+        name = file.getName().lower()
+        if name == DB_FILE:
+            return self.iter_db_records if self.local_settings.get_parse_log() else None
+        if not self.local_settings.get_parse_settings():
+            return None
+        if name in (ROOM_MANAGER_FILE, ENV_INFO_FILE):
+            return self.iter_xml_records
+        if name == DEVICE_LOG_FILE and "data" in file.getParentPath().lower() and is_mihome_config(file):
+            return self.iter_xml_records
+        return None
+
+    # Logs the counters of the job and posts its summary to the ingest messages inbox
+    def report(self):
+        self.log(Level.INFO, str(self.types))
+        self.log(Level.INFO, str(self.writer))
+        self.log(Level.INFO, str(self.index))
+        self.log(Level.INFO, str(self.dedup))
+        self.log(Level.INFO, str(self.timestamps))
+
+        # FINISHED!
+        # Post a message to the ingest messages in box.
+        message = IngestMessage.createMessage(IngestMessage.MessageType.DATA,
+                                              "MiHome Analysis", "Analyzed %d files (%d unchanged since last run)" % (self.job.files, self.index.skipped),
+                                              "<br>".join(self.stats.summary() + [self.dedup.summary()]))
+        IngestServices.getInstance().postMessage(message)
+
+    def flag_file(self, file):
+        # Make an artifact on the blackboard.
+        # Set the DB file as an "interesting file" : TSK_INTERESTING_FILE_HIT is a generic type of
+        # artifact.  Refer to the developer docs for other examples.
+        art = file.newArtifact(BlackboardArtifact.ARTIFACT_TYPE.TSK_INTERESTING_FILE_HIT)
+        att = BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_SET_NAME,
+                                  MiHomeIngestModuleFactory.moduleName, "Mi Home")
+        art.addAttribute(att)
+
+    # Yields the entries of a SharedPreferences file, read straight from the file content through a bounded
+    # read buffer. Exporting the file to the case temp directory is only used as a fallback if reading the
+    # content fails before any entry was produced.
+    def iter_entries(self, file, context):
+        streaming = context.streaming
+        stats = context.stats
+        stream = MiHomeContentStream(file, READ_BUFFER_SIZE)
+        context.stream = stream
+        entries = 0
+        try:
+            for entry in iter_xml_entries(stream, streaming):
+                entries += 1
+                yield entry
+            return
+        except ET.ParseError:
+            raise
+        except Exception as e:
+            if entries:
+                raise
+            self.log(Level.WARNING, "Error while reading content of file: " + file.getName() +
+                     ", falling back to temp file - " + str(e))
+        finally:
+            stream.close()
+            stats.add("extraction", stream.seconds, stream.bytes_read)
+
+        lcl_setting_path = os.path.join(Case.getCurrentCase().getTempDirectory(), str(file.getId()) + ".xml")
+        start = clock()
+        ContentUtils.writeToFile(file, File(lcl_setting_path))
+        stats.add("extraction", clock() - start, file.getSize())
+        try:
+            for entry in iter_xml_entries(lcl_setting_path, streaming):
+                yield entry
+        finally:
+            # Clean Up
+            os.remove(lcl_setting_path)
+
+    # Writes the records of a file and records it in the index, flagging it on its first run.
+    # The file is only recorded as complete if all its records were written, otherwise it will be processed
+    # again and only the delta posted then.
+    def process_file(self, file, records):
+        self.log(Level.INFO, "Processing file: " + file.getName())
+
+        if not self.index.is_known(file):
+            self.flag_file(file)
+
+        self.index.begin(file)
+        complete = False
+        try:
+            complete = self.parse_records(file, records)
+        finally:
+            # Post whatever was buffered, by this thread or others, before the file is recorded as done
+            lost = self.writer.flush(file)
+            self.index.commit(file, complete and not lost and not self.context.isJobCancelled(), lost)
+
+    # Writes the records produced for a file, stopping at the first error or when the job is cancelled.
+    # Returns True only if all the records of the file were written.
+    def parse_records(self, file, records):
+        count = 0
+        try:
+            for record in records:
+                self.add_record(file, record)
+                count += 1
+                if count % PROGRESS_INTERVAL == 0:
+                    if self.context.isJobCancelled():
+                        return False
+                    if self.progress is not None:
+                        self.progress.update(file, count)
+            return True
+        except Exception as e:
+            self.log(Level.INFO, "Error while processing file: " + file.getName())
+            self.log(Level.INFO, "Error MSG: " + str(e))
+            return False
+        finally:
+            records.close()
+
+    # Yields the records stored in a miio.db file. The DB is copied once to the case temp directory, with its
+    # WAL and journal files if any, and its tables are read with forward-only cursors, rows are never collected first.
+    def iter_db_records(self, file):
+        stats = MiHomeStats()
+        lcl_db_path = os.path.join(Case.getCurrentCase().getTempDirectory(), str(file.getId()) + ".db")
+        start = clock()
+        ContentUtils.writeToFile(file, File(lcl_db_path))
+        stats.add("extraction", clock() - start, file.getSize())
+        connection = None
+        try:
+            for suffix, sidecar in self.find_db_sidecars(file):
+                start = clock()
+                ContentUtils.writeToFile(sidecar, File(lcl_db_path + suffix))
+                stats.add("extraction", clock() - start, sidecar.getSize())
+                self.log(Level.INFO, "Copied " + sidecar.getName() + " along with file: " + file.getName())
+
+            Class.forName("org.sqlite.JDBC").newInstance()
+            connection = DriverManager.getConnection("jdbc:sqlite:%s" % lcl_db_path)
+            rows = 0
+            records = iter_db_table_records(connection, DB_FETCH_SIZE, self.timestamps)
+            try:
+                for record in stats.timed("db_query", records):
+                    yield record
+                    rows += 1
+                    if rows % DB_FETCH_SIZE == 0 and self.context.isJobCancelled():
+                        break
+            finally:
+                records.close()
+            self.log(Level.INFO, "Extracted " + str(rows) + " records from file: " + file.getName())
+        finally:
+            if connection is not None:
+                connection.close()
+            # Clean Up
+            os.remove(lcl_db_path)
+            for suffix in DB_TEMP_SUFFIXES:
+                if os.path.exists(lcl_db_path + suffix):
+                    os.remove(lcl_db_path + suffix)
+            self.stats.merge(stats)
+
+    # Returns the (suffix, file) pairs of the SQLite WAL and journal files found next to a DB file
+    def find_db_sidecars(self, file):
+        names = dict((file.getName().lower() + suffix, suffix) for suffix in DB_SIDECAR_SUFFIXES)
+        where = "data_source_obj_id = {} AND parent_path = '{}' AND LOWER(name) IN ({})".format(
+            file.getDataSource().getId(), file.getParentPath().replace("'", "''"),
+            ", ".join("'" + name.replace("'", "''") + "'" for name in names))
+        case = Case.getCurrentCase().getSleuthkitCase()
+        return [(names[sidecar.getName().lower()], sidecar) for sidecar in case.findAllFilesWhere(where)
+                if sidecar.getSize() > 0]
+
+    def add_record(self, file, record):
+        # Already posted by a previous run on this file
+        key = self.index.key(record)
+        if self.index.is_posted(key):
+            return
+
+        if record[0] == RECORD_EVENT:
+            # Same event already posted from another snapshot, file or backup
+            if self.dedup.is_duplicate(*record[1:]):
+                return
+            self.add_event(file, *record[1:], key=key)
+        elif record[0] == RECORD_HOME:
+            self.add_home(file, *record[1:], key=key)
+        elif record[0] == RECORD_DEVICE:
+            self.add_device(file, *record[1:], key=key)
+        elif record[0] == RECORD_DB_DEVICE:
+            self.add_db_device(file, *record[1:], key=key)
+
+    # Yields the records found in a file one at a time, as (RECORD_* type, add_* arguments...) tuples.
+    # Each entry is routed to its parser with a single lookup, see entry_parser. Entries without a parser
+    # are skipped without being unescaped or decoded.
+    def iter_xml_records(self, file):
+        context = MiHomeEntryContext(self, self.local_settings.get_streaming_parse())
+        stats = context.stats
+        if self.progress is not None:
+            self.progress.reading(file, context)
+        entries = self.iter_entries(file, context)
+        count = 0
+        try:
+            for child in stats.timed("xml_parse", entries):
+                match = ENTRY_NAME_PATTERN.search(child.attrib.get("name", ""))
+                if match is not None:
+                    context.enter(child.text)
+                    for record in ENTRY_PARSERS[match.lastgroup](context, child.text, match):
+                        yield record
+                        # A single entry may hold millions of events, stop within the entry on cancel
+                        count += 1
+                        if count % PROGRESS_INTERVAL == 0 and self.context.isJobCancelled():
+                            return
+        finally:
+            entries.close()
+            # The content is read while the XML is parsed, only count it once
+            stats.seconds["xml_parse"] -= stats.seconds["extraction"]
+            stats.add_cache("payload_cache", context.cache.hits, context.cache.misses)
+            stats.add_cache("string_pool", context.cache.string_hits, context.cache.string_misses)
+            self.stats.merge(stats)
+
+    # 'ev_raw' is the event timestamp as stored, 'tz_offset' the timezone correction applied to it, if any.
+    # 'key' identifies the record in the index, see MiHomeArtifactWriter.add.
+    def add_event(self, file, event, ev_date, log_date, ev_type, ev_device, ev_raw, tz_offset=0, key=None):
+
+        # Artifact
+        art_type_id = self.types.artifact_type("ESC_IOT_MIHOME_EVENTS", "Mi Home - Events")
+
+        # Attributes
+        attributes = []
+
+        att_event_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_EVENT_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Event")
+        att_log_ts_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_LOG_DATE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.DATETIME, "Log Timestamp")
+        att_ev_ts_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_EVENT_DATE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.DATETIME, "Event Timestamp")
+        att_ev_type_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_EVENT_TYPE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Event Type")
+        att_ev_device_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_EVENT_DEVICE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Device")
+
+        attributes.append(BlackboardAttribute(att_event_id, MiHomeIngestModuleFactory.moduleName, event))
+        attributes.append(BlackboardAttribute(att_log_ts_id, MiHomeIngestModuleFactory.moduleName, log_date))
+        attributes.append(BlackboardAttribute(att_ev_ts_id, MiHomeIngestModuleFactory.moduleName, ev_date))
+        attributes.append(BlackboardAttribute(att_ev_type_id, MiHomeIngestModuleFactory.moduleName, ev_type))
+        attributes.append(BlackboardAttribute(att_ev_device_id, MiHomeIngestModuleFactory.moduleName, ev_device))
+
+        # Corrected timestamps keep the value stored by the device, so that the correction can be checked
+        if tz_offset:
+            att_raw_ts_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_RAW_EVENT_DATE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.DATETIME, "Event Timestamp (As Stored)")
+            att_tz_fix_id = self.types.attribute_type("ESC_IOT_MIHOME_EVENTS_TZ_CORRECTION", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Timezone Correction")
+            attributes.append(BlackboardAttribute(att_raw_ts_id, MiHomeIngestModuleFactory.moduleName, ev_date + tz_offset))
+            attributes.append(BlackboardAttribute(att_tz_fix_id, MiHomeIngestModuleFactory.moduleName,
+                                                  "{:+.2f}h".format(-tz_offset / 3600.0)))
+
+        self.writer.add(file, art_type_id, attributes, key)
+    
+    def add_home(self, file, home_name, home_id, home_address, home_latitude, home_longitude, key=None):
+
+        # Artifact
+        art_type_id = self.types.artifact_type("ESC_IOT_MIHOME_HOME", "Mi Home - Home Details")
+
+        # Attributes
+        attributes = []
+
+        att_home_name_id = self.types.attribute_type("ESC_IOT_MIHOME_HOME_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Name")
+        att_home_id_id = self.types.attribute_type("ESC_IOT_MIHOME_HOME_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "ID")
+        att_home_address_id = self.types.attribute_type("ESC_IOT_MIHOME_HOME_ADDRESS", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Address")
+        att_home_lat_id = self.types.attribute_type("ESC_IOT_MIHOME_HOME_LATITUDE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Latitude")
+        att_home_lon_id = self.types.attribute_type("ESC_IOT_MIHOME_HOME_LONGITUDE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Longitude")
+
+        attributes.append(BlackboardAttribute(att_home_name_id, MiHomeIngestModuleFactory.moduleName, home_name))
+        attributes.append(BlackboardAttribute(att_home_id_id, MiHomeIngestModuleFactory.moduleName, home_id))
+        attributes.append(BlackboardAttribute(att_home_address_id, MiHomeIngestModuleFactory.moduleName, home_address))
+        attributes.append(BlackboardAttribute(att_home_lat_id, MiHomeIngestModuleFactory.moduleName, home_latitude))
+        attributes.append(BlackboardAttribute(att_home_lon_id, MiHomeIngestModuleFactory.moduleName, home_longitude))
+
+        self.writer.add(file, art_type_id, attributes, key)
+
+    def add_device(self, file, room_name, room_id, home_id, device, key=None):
+
+        # Artifact
+        art_type_id = self.types.artifact_type("ESC_IOT_MIHOME_DEVICES", "Mi Home -  Rooms & Devices")
+
+        # Attributes
+        attributes = []
+
+        att_room_name_id = self.types.attribute_type("ESC_IOT_MIHOME_DEVICES_ROOM_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Room Name")
+        att_room_id_id = self.types.attribute_type("ESC_IOT_MIHOME_DEVICES_ROOM_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Room ID")
+        att_home_id_id = self.types.attribute_type("ESC_IOT_MIHOME_DEVICES_HOME_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Home ID")
+        att_device_id_id = self.types.attribute_type("ESC_IOT_MIHOME_DEVICES_DEVICE_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Device ID")
+
+        attributes.append(BlackboardAttribute(att_room_name_id, MiHomeIngestModuleFactory.moduleName, room_name))
+        attributes.append(BlackboardAttribute(att_room_id_id, MiHomeIngestModuleFactory.moduleName, room_id))
+        attributes.append(BlackboardAttribute(att_home_id_id, MiHomeIngestModuleFactory.moduleName, home_id))
+        attributes.append(BlackboardAttribute(att_device_id_id, MiHomeIngestModuleFactory.moduleName, device))
+
+        self.writer.add(file, art_type_id, attributes, key)
+
+    def add_db_device(self, file, device, name, model, mac, ip, ssid, latitude, longitude, key=None):
+
+        # Artifact
+        art_type_id = self.types.artifact_type("ESC_IOT_MIHOME_DB_DEVICES", "Mi Home - Devices")
+
+        # Attributes
+        attributes = []
+
+        att_device_id_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_DEVICE_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Device ID")
+        att_name_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Name")
+        att_model_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_MODEL", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Model")
+        att_mac_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_MAC", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "MAC Address")
+        att_ip_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_IP", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "IP Address")
+        att_ssid_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_SSID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "SSID")
+        att_lat_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_LATITUDE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Latitude")
+        att_lon_id = self.types.attribute_type("ESC_IOT_MIHOME_DB_DEVICES_LONGITUDE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Longitude")
+
+        # Columns missing from the DB are left out
+        for att_id, value in ((att_device_id_id, device), (att_name_id, name), (att_model_id, model),
+                              (att_mac_id, mac), (att_ip_id, ip), (att_ssid_id, ssid),
+                              (att_lat_id, latitude), (att_lon_id, longitude)):
+            if value is not None:
+                attributes.append(BlackboardAttribute(att_id, MiHomeIngestModuleFactory.moduleName, value))
+
+        self.writer.add(file, art_type_id, attributes, key)
+
+
+# Data Source-level ingest module.  One gets created per data source.
+class MiHomeIngestModule(MiHomeIngestParser, DataSourceIngestModule):
 
     # Where any setup and configuration is done
     # 'context' is an instance of org.sleuthkit.autopsy.ingest.IngestJobContext.
@@ -101,6 +499,13 @@ class MiHomeIngestModule(DataSourceIngestModule):
 
         self.context = context
 
+        # The files are parsed by MiHomeFileIngestModule instead
+        if self.local_settings.get_file_pipeline():
+            return
+
+        # A single module runs per data source, its state is not shared
+        self.attach(MiHomeJobState(self.local_settings))
+
     # Where the analysis is done.
     # The 'dataSource' object being passed in is of type org.sleuthkit.datamodel.Content.
     # See: http://www.sleuthkit.org/sleuthkit/docs/jni-docs/4.4/interfaceorg_1_1sleuthkit_1_1datamodel_1_1_content.html
@@ -109,6 +514,9 @@ class MiHomeIngestModule(DataSourceIngestModule):
     # TODO: Add your analysis code in here.
     def process(self, dataSource, progressBar):
 
+        if self.job is None:
+            return IngestModule.ProcessResult.OK
+
         # we don't know how much work there is yet
         progressBar.switchToIndeterminate()
 
@@ -118,215 +526,120 @@ class MiHomeIngestModule(DataSourceIngestModule):
         # Get case
         case = Case.getCurrentCase().getSleuthkitCase()
 
-        # For our example, we will use FileManager to get all
-        # files with the word "test"
-        # in the name and then count and read them
-        # FileManager API: http://sleuthkit.org/autopsy/docs/api-docs/4.4/classorg_1_1sleuthkit_1_1autopsy_1_1casemodule_1_1services_1_1_file_manager.html
-        fileManager = Case.getCurrentCase().getServices().getFileManager()
+        # All the candidate files are found with a single query on the case DB
+        start = clock()
+        found = self.find_files(case, dataSource)
+        db_files = found.get(DB_FILE, [])
+        home_room_manager = found.get(ROOM_MANAGER_FILE, [])
+        home_env_info = found.get(ENV_INFO_FILE, [])
 
-        db_files = fileManager.findFiles(dataSource, "miio.db") # if self.local_settings.get_parse_db() else []
-        if self.local_settings.get_parse_settings():
-            # Yes, Alerm, they have a typo in the file
-            home_room_manager = fileManager.findFiles(dataSource, "home_room_manager_sp_.xml")
-            home_env_info = fileManager.findFiles(dataSource, "home_env_info.xml")
-            device_logs = fileManager.findFiles(dataSource, "config.xml", "data")
-        else:
-            home_room_manager, home_env_info, device_logs = [], [], []
+        # config.xml is a common name, files of other apps are dropped after a look at their first bytes
+        device_logs = [file for file in found.get(DEVICE_LOG_FILE, []) if is_mihome_config(file)]
+        ignored = len(found.get(DEVICE_LOG_FILE, [])) - len(device_logs)
+        if ignored:
+            self.log(Level.INFO, "ignored " + str(ignored) + " config.xml files not related to MiHome")
 
         num_files = len(db_files) + len(home_room_manager) + len(home_env_info) + len(device_logs)
+        stats = MiHomeStats()
+        stats.add("discovery", clock() - start, num_files)
 
         self.log(Level.INFO, "found " + str(num_files) + " files")
-        progressBar.switchToDeterminate(num_files)
-        file_count = 0
 
-        # Settings
-        if self.local_settings.get_parse_settings():
-            # Settings File
-            for file in home_room_manager + home_env_info + device_logs:
+        # Settings Files first, then DBs
+        parse_jobs = [(file, self.iter_xml_records) for file in home_room_manager + home_env_info + device_logs]
+        parse_jobs += [(file, self.iter_db_records) for file in db_files]
+
+        # Progress is measured in bytes of content, large files move the bar while they are parsed
+        self.progress = MiHomeProgress(progressBar, sum(file.getSize() for file, read in parse_jobs))
+
+        # Files already processed by a previous run and not changed since are skipped
+        pending_jobs = []
+        for file, read in parse_jobs:
+            if self.index.is_unchanged(file):
+                self.log(Level.INFO, "Skipping unchanged file: " + file.getName())
+                self.job.count_file()
+                self.progress.skip(file)
+            else:
+                pending_jobs.append((file, read))
+
+        # Files are read and decoded by the worker pool, artifacts are written here, in the original order
+        pool = MiHomeParserPool(self.local_settings.get_worker_threads(), self.context.isJobCancelled)
+        try:
+            for file, records in pool.imap(pending_jobs):
 
                 # Check if the user pressed cancel while we were busy
                 if self.context.isJobCancelled():
                     return IngestModule.ProcessResult.OK
 
-                self.log(Level.INFO, "Processing file: " + file.getName())
-                file_count += 1
-
-                # Make an artifact on the blackboard.
-                # Set the DB file as an "interesting file" : TSK_INTERESTING_FILE_HIT is a generic type of
-                # artifact.  Refer to the developer docs for other examples.
-                art = file.newArtifact(BlackboardArtifact.ARTIFACT_TYPE.TSK_INTERESTING_FILE_HIT)
-                att = BlackboardAttribute(BlackboardAttribute.ATTRIBUTE_TYPE.TSK_SET_NAME,
-                                          MiHomeIngestModuleFactory.moduleName, "Mi Home")
-                art.addAttribute(att)
-
-                # Write to file (any way to contour this?)
-                lcl_setting_path = os.path.join(Case.getCurrentCase().getTempDirectory(), str(file.getId()) + ".xml")
-                ContentUtils.writeToFile(file, File(lcl_setting_path))
+                self.job.count_file()
+                self.process_file(file, records)
+                self.progress.finish(file)
+        finally:
+            pool.shutdown()
+            self.stats.merge(stats)
+            self.job.close()
+            self.log(Level.INFO, str(self.stats))
 
-                self.parse_xml(lcl_setting_path, file)
-
-                # Clean Up
-                os.remove(lcl_setting_path)
-
-                progressBar.progress(file_count)
-
-        # FINISHED!
-        # Post a message to the ingest messages in box.
-        message = IngestMessage.createMessage(IngestMessage.MessageType.DATA,
-                                              "MiHome Analysis", "Analyzed %d files" % file_count)
-        IngestServices.getInstance().postMessage(message)
+        self.report()
 
         return IngestModule.ProcessResult.OK
 
-    def parse_xml(self, filename, file):
-        try:
-            tree = ET.parse(filename)
-            root = tree.getroot()
-            for child in root:
-                attribute_name = child.attrib.get("name", "")
-                if "Log_Normal" in attribute_name:
-                    # Use normal log parser
-                    for log in json.loads(child.text).get("value", []):
-                        device = log.get("did")
-                        log_ts = ts_uniform_to_seconds(log.get("time"))
-                        ev_type = log.get("type")
-                        for payload in json.loads(log.get("value", "[]")):
-                            payload = json.loads(payload)
-                            ev_ts = ts_uniform_to_seconds(payload[0])
-                            for item in payload[1]:
-                                if item:
-                                    event = item
-                                    self.add_event(file, event, ev_ts, log_ts, ev_type, device)
-
-                if "ht_stat" in attribute_name:
-                    # Use Temperature Parser
-                    pattern = re.compile(r"(?P<device_id>.*)_ht_stat*.")
-                    device = re.match(pattern, attribute_name).group("device_id")
-                    data = json.loads(child.text)
-                    log_ts = ts_uniform_to_seconds(data.get("time"))
-                    for log in json.loads(data.get("value", "[]")):
-                        ev_ts = ts_uniform_to_seconds(log.get("time"))
-                        for event, value in log.items():
-                            if event != "time":
-                                print("Event Type: " + event)
-                                print("Event Value: " + value)
-                                self.add_event(file, value, ev_ts, log_ts, event, device)
-
-                if "env_data" in attribute_name:
-                    # Use Env Parser
-                    env_data = json.loads(HTMLParser.HTMLParser().unescape(child.text))
-                    for item in env_data.get("description_list"):
-                        device = item.get("did")
-                        for detail in item.get("details", []):
-                            ev_type = detail.get("prop")
-                            ev_ts = detail.get("timestamp")
-                            event = detail.get("description")
-                            self.add_event(file, event, ev_ts, ev_ts, ev_type, device)
-
-                if "home_room_content" in attribute_name:
-                    # Use Env Parser
-                    home_data = json.loads(HTMLParser.HTMLParser().unescape(child.text))
-                    for home in home_data.get("homelist", []):
-                        home_name =  home.get("name")
-                        home_id = home.get("id")
-                        home_address = home.get("address")
-                        home_latitude = str(home.get("latitude"))
-                        home_longitude = str(home.get("longitude"))
-                        self.add_home(file, home_name, home_id, home_address, home_latitude, home_longitude)
-                        for room in home.get("roomlist", []):
-                            room_name = room.get("name")
-                            room_id = room.get("id")
-                            for device in room.get("dids", []):
-                                print("Device: " + device)
-                                self.add_device(file, room_name, room_id, home_id, device)
-        except Exception as e:
-            self.log(Level.INFO, "Error while processing file: " + file.getName())
-            self.log(Level.INFO, "Error MSG: " + str(e))
-
-    def add_event(self, file, event, ev_date, log_date, ev_type, ev_device):
-        
-        # Get Blackboard
-        sk_case = Case.getCurrentCase().getSleuthkitCase()
-        blackboard = sk_case.getBlackboard()
-        
-        # Artifact 
-        art_type_id = blackboard.getOrAddArtifactType("ESC_IOT_MIHOME_EVENTS", "Mi Home - Events").getTypeID()
-        artifact = file.newArtifact(art_type_id)
-        
-        # Attributes
-        attributes = []
-
-        att_event_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_EVENTS_EVENT_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Event")
-        att_log_ts_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_EVENTS_LOG_DATE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.DATETIME, "Log Timestamp")
-        att_ev_ts_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_EVENTS_EVENT_DATE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.DATETIME, "Event Timestamp")
-        att_ev_type_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_EVENTS_EVENT_TYPE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Event Type")
-        att_ev_device_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_EVENTS_EVENT_DEVICE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Device")
+    # Returns the candidate files of the data source, by lower case name
+    def find_files(self, case, dataSource):
+        names = []
+        if self.local_settings.get_parse_settings():
+            names += [ROOM_MANAGER_FILE, ENV_INFO_FILE, DEVICE_LOG_FILE]
+        if self.local_settings.get_parse_log():
+            names.append(DB_FILE)
+        if not names:
+            return {}
 
-        attributes.append(BlackboardAttribute(att_event_id, MiHomeIngestModuleFactory.moduleName, event))
-        attributes.append(BlackboardAttribute(att_log_ts_id, MiHomeIngestModuleFactory.moduleName, log_date))
-        attributes.append(BlackboardAttribute(att_ev_ts_id, MiHomeIngestModuleFactory.moduleName, ev_date))
-        attributes.append(BlackboardAttribute(att_ev_type_id, MiHomeIngestModuleFactory.moduleName, ev_type))
-        attributes.append(BlackboardAttribute(att_ev_device_id, MiHomeIngestModuleFactory.moduleName, ev_device))
+        # Same matching as FileManager.findFiles: case insensitive names, config.xml only under a "data" folder
+        where = "data_source_obj_id = {} AND LOWER(name) IN ({}) AND (LOWER(name) <> '{}' OR LOWER(parent_path) LIKE '%data%')".format(
+            dataSource.getId(), ", ".join("'" + name + "'" for name in names), DEVICE_LOG_FILE)
 
-        artifact.addAttributes(attributes)
+        found = {}
+        for file in case.findAllFilesWhere(where):
+            found.setdefault(file.getName().lower(), []).append(file)
+        return found
 
-        blackboard.postArtifact(artifact, MiHomeIngestModuleFactory.moduleName)
-    
-    def add_home(self, file, home_name, home_id, home_address, home_latitude, home_longitude):
-        
-        # Get Blackboard
-        sk_case = Case.getCurrentCase().getSleuthkitCase()
-        blackboard = sk_case.getBlackboard()
-        
-        # Artifact 
-        art_type_id = blackboard.getOrAddArtifactType("ESC_IOT_MIHOME_HOME", "Mi Home - Home Details").getTypeID()
-        artifact = file.newArtifact(art_type_id)
-        
-        # Attributes
-        attributes = []
 
-        att_home_name_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_HOME_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Name")
-        att_home_id_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_HOME_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "ID")
-        att_home_address_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_HOME_ADDRESS", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Address")
-        att_home_lat_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_HOME_LATITUDE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Latitude")
-        att_home_lon_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_HOME_LONGITUDE", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Longitude")
+# File-level ingest module, used instead of MiHomeIngestModule when the file pipeline is selected in the settings.
+# Autopsy runs one instance per file ingest thread: MiHome files are recognised by name and path as they go
+# through the pipeline and parsed there, on the pipeline thread. The instances of a job share its MiHomeJobState,
+# the last one shut down posts what is left and reports.
+class MiHomeFileIngestModule(MiHomeIngestParser, FileIngestModule):
 
-        attributes.append(BlackboardAttribute(att_home_name_id, MiHomeIngestModuleFactory.moduleName, home_name))
-        attributes.append(BlackboardAttribute(att_home_id_id, MiHomeIngestModuleFactory.moduleName, home_id))
-        attributes.append(BlackboardAttribute(att_home_address_id, MiHomeIngestModuleFactory.moduleName, home_address))
-        attributes.append(BlackboardAttribute(att_home_lat_id, MiHomeIngestModuleFactory.moduleName, home_latitude))
-        attributes.append(BlackboardAttribute(att_home_lon_id, MiHomeIngestModuleFactory.moduleName, home_longitude))
-
-        artifact.addAttributes(attributes)
+    def startUp(self, context):
+        self.context = context
+        if self.local_settings.get_file_pipeline():
+            self.attach(MiHomeJobState.acquire(context.getJobId(), self.local_settings))
 
-        blackboard.postArtifact(artifact, MiHomeIngestModuleFactory.moduleName)
+    # 'file' is of type org.sleuthkit.datamodel.AbstractFile, most of them are not MiHome files
+    def process(self, file):
+        if self.job is None or not file.isFile():
+            return IngestModule.ProcessResult.OK
 
-    def add_device(self, file, room_name, room_id, home_id, device):
-        
-        # Get Blackboard
-        sk_case = Case.getCurrentCase().getSleuthkitCase()
-        blackboard = sk_case.getBlackboard()
-        
-        # Artifact 
-        art_type_id = blackboard.getOrAddArtifactType("ESC_IOT_MIHOME_DEVICES", "Mi Home -  Rooms & Devices").getTypeID()
-        artifact = file.newArtifact(art_type_id)
-        
-        # Attributes
-        attributes = []
+        read = self.reader(file)
+        if read is None:
+            return IngestModule.ProcessResult.OK
 
-        att_room_name_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_DEVICES_ROOM_NAME", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Room Name")
-        att_room_id_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_DEVICES_ROOM_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Room ID")
-        att_home_id_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_DEVICES_HOME_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Home ID")
-        att_device_id_id = blackboard.getOrAddAttributeType("ESC_IOT_MIHOME_DEVICES_DEVICE_ID", BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Device ID")
+        self.job.count_file()
+        if self.index.is_unchanged(file):
+            self.log(Level.INFO, "Skipping unchanged file: " + file.getName())
+            return IngestModule.ProcessResult.OK
 
-        attributes.append(BlackboardAttribute(att_room_name_id, MiHomeIngestModuleFactory.moduleName, room_name))
-        attributes.append(BlackboardAttribute(att_room_id_id, MiHomeIngestModuleFactory.moduleName, room_id))
-        attributes.append(BlackboardAttribute(att_home_id_id, MiHomeIngestModuleFactory.moduleName, home_id))
-        attributes.append(BlackboardAttribute(att_device_id_id, MiHomeIngestModuleFactory.moduleName, device))
+        self.process_file(file, read(file))
+        return IngestModule.ProcessResult.OK
 
-        artifact.addAttributes(attributes)
+    def shutDown(self):
+        if self.job is None:
+            return
+        if MiHomeJobState.release(self.context.getJobId()):
+            self.job.close()
+            self.log(Level.INFO, str(self.stats))
+            self.report()
 
-        blackboard.postArtifact(artifact, MiHomeIngestModuleFactory.moduleName)
 
 # Stores the settings that can be changed for each ingest job
 # All fields in here must be serializable.  It will be written to disk.
@@ -337,6 +650,14 @@ class MiHomeIngestModuleSettings(IngestModuleIngestJobSettings):
     def __init__(self):
         self.parse_log = True
         self.parse_settings = True
+        self.batch_size = 500
+        self.streaming_parse = True
+        self.incremental = True
+        self.fix_timezone = True
+        self.dedup_events = True
+        self.dedup_memory_mb = DEDUP_MEMORY_MB
+        self.file_pipeline = False
+        self.worker_threads = min(4, Runtime.getRuntime().availableProcessors())
 
     def getVersionNumber(self):
         return serialVersionUID
@@ -354,9 +675,58 @@ class MiHomeIngestModuleSettings(IngestModuleIngestJobSettings):
     def set_parse_settings(self, flag):
         self.parse_settings = flag
 
+    def get_streaming_parse(self):
+        return self.streaming_parse
+
+    def set_streaming_parse(self, flag):
+        self.streaming_parse = flag
+
+    def get_incremental(self):
+        return self.incremental
+
+    def set_incremental(self, flag):
+        self.incremental = flag
+
+    def get_fix_timezone(self):
+        return self.fix_timezone
+
+    def set_fix_timezone(self, flag):
+        self.fix_timezone = flag
+
+    def get_dedup_events(self):
+        return self.dedup_events
+
+    def set_dedup_events(self, flag):
+        self.dedup_events = flag
+
+    def get_dedup_memory_mb(self):
+        return self.dedup_memory_mb
+
+    def set_dedup_memory_mb(self, size):
+        self.dedup_memory_mb = size
+
+    def get_file_pipeline(self):
+        return self.file_pipeline
+
+    def set_file_pipeline(self, flag):
+        self.file_pipeline = flag
+
+    def get_worker_threads(self):
+        return self.worker_threads
+
+    def set_worker_threads(self, count):
+        self.worker_threads = count
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def set_batch_size(self, size):
+        self.batch_size = size
+
     def __str__(self):
-        return "MiHome Parser - Settings: Parse_DB = {}, Parse_Settings = {}".format(
-            self.parse_log, self.parse_settings)
+        return "MiHome Parser - Settings: Parse_DB = {}, Parse_Settings = {}, Streaming = {}, Incremental = {}, Fix_Timezone = {}, Dedup_Events = {} ({} MB), File_Pipeline = {}, Workers = {}, Batch_Size = {}".format(
+            self.parse_log, self.parse_settings, self.streaming_parse, self.incremental, self.fix_timezone,
+            self.dedup_events, self.dedup_memory_mb, self.file_pipeline, self.worker_threads, self.batch_size)
 
 
 # UI that is shown to user for each ingest job so they can configure the job.
@@ -389,31 +759,1236 @@ class MiHomeIngestModuleSettingsPanel(IngestModuleIngestJobSettingsPanel):
         else:
             self.local_settings.set_parse_settings(False)
 
+    def incremental_checkbox_event(self, event):
+        self.local_settings.set_incremental(self.incremental_checkbox.isSelected())
+
+    def dedup_checkbox_event(self, event):
+        self.local_settings.set_dedup_events(self.dedup_checkbox.isSelected())
+
+    def timezone_checkbox_event(self, event):
+        self.local_settings.set_fix_timezone(self.timezone_checkbox.isSelected())
+
+    def pipeline_checkbox_event(self, event):
+        self.local_settings.set_file_pipeline(self.pipeline_checkbox.isSelected())
+
+    def workers_spinner_event(self, event):
+        self.local_settings.set_worker_threads(self.workers_spinner.getValue())
+
     def initComponents(self):
-        # self.setLayout(BoxLayout(self, BoxLayout.Y_AXIS))
-        # self.log_parse_checkbox = JCheckBox("Parse Device Logs", actionPerformed=self.log_checkbox_event)
-        # self.add(self.log_parse_checkbox)
-        # self.settings_parse_checkbox = JCheckBox("Parse Setting Files", actionPerformed=self.settings_checkbox_event)
-        # self.add(self.settings_parse_checkbox)
-        pass
+        self.setLayout(BoxLayout(self, BoxLayout.Y_AXIS))
+        self.log_parse_checkbox = JCheckBox("Parse Device Logs", actionPerformed=self.log_checkbox_event)
+        self.add(self.log_parse_checkbox)
+        self.settings_parse_checkbox = JCheckBox("Parse Setting Files", actionPerformed=self.settings_checkbox_event)
+        self.add(self.settings_parse_checkbox)
+        self.incremental_checkbox = JCheckBox("Skip files unchanged since the last run",
+                                              actionPerformed=self.incremental_checkbox_event)
+        self.add(self.incremental_checkbox)
+        self.dedup_checkbox = JCheckBox("Post identical events only once", actionPerformed=self.dedup_checkbox_event)
+        self.add(self.dedup_checkbox)
+        self.timezone_checkbox = JCheckBox("Correct timezone shifted event timestamps",
+                                           actionPerformed=self.timezone_checkbox_event)
+        self.add(self.timezone_checkbox)
+        self.pipeline_checkbox = JCheckBox("Parse files in the file ingest pipeline",
+                                           actionPerformed=self.pipeline_checkbox_event)
+        self.add(self.pipeline_checkbox)
+        # Parser threads of the data source module, the file pipeline uses the Autopsy ingest threads
+        workers_panel = JPanel()
+        workers_panel.add(JLabel("Parser threads:"))
+        self.workers_spinner = JSpinner(SpinnerNumberModel(1, 1, 32, 1), stateChanged=self.workers_spinner_event)
+        workers_panel.add(self.workers_spinner)
+        self.add(workers_panel)
 
     def customizeComponents(self):
-        # self.log_parse_checkbox.setSelected(self.local_settings.get_parse_log())
-        # self.settings_parse_checkbox.setSelected(self.local_settings.get_parse_settings())
-        pass
+        self.log_parse_checkbox.setSelected(self.local_settings.get_parse_log())
+        self.settings_parse_checkbox.setSelected(self.local_settings.get_parse_settings())
+        self.incremental_checkbox.setSelected(self.local_settings.get_incremental())
+        self.dedup_checkbox.setSelected(self.local_settings.get_dedup_events())
+        self.timezone_checkbox.setSelected(self.local_settings.get_fix_timezone())
+        self.pipeline_checkbox.setSelected(self.local_settings.get_file_pipeline())
+        self.workers_spinner.setValue(self.local_settings.get_worker_threads())
 
     # Return the settings used
     def getSettings(self):
         return self.local_settings
 
 
-def ts_uniform_to_seconds(timestamp):
-    boundary = datetime.now()+timedelta(1) # Boundary is today + 1 day
+# State of an ingest job: type cache, artifact writer, index, event filter and statistics, all thread-safe.
+# In file pipeline mode the modules of a job share one instance, found by job ID and released by the last
+# module shut down.
+class MiHomeJobState(object):
+    jobs = {}
+    jobs_lock = threading.Lock()
+
+    def __init__(self, settings):
+        # Artifact and attribute types are resolved against the case DB once per job
+        self.types = MiHomeTypeRegistry(Case.getCurrentCase().getSleuthkitCase().getBlackboard())
+
+        # Artifacts are created and posted to the blackboard in batches
+        self.writer = MiHomeArtifactWriter(self.types.blackboard, settings.get_batch_size())
+
+        # Time spent in each stage of the job
+        self.stats = MiHomeStats()
+
+        # Timestamp resolution boundaries are computed once per job
+        self.timestamps = MiHomeTimestampNormaliser(settings.get_fix_timezone())
+
+        # Files and artifacts handled by previous runs on this case
+        index_dir = os.path.join(Case.getCurrentCase().getModuleDirectory(), "MiHome")
+        self.index = MiHomeIngestIndex(index_dir, settings.get_incremental())
+
+        # Events already posted during this job, copies found in other snapshots or files are dropped
+        self.dedup = MiHomeEventFilter(settings.get_dedup_events(), settings.get_dedup_memory_mb())
+
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.files = 0
+
+    # Returns the state of the job, created by the first module of the job
+    @classmethod
+    def acquire(cls, job_id, settings):
+        with cls.jobs_lock:
+            job = cls.jobs.get(job_id)
+            if job is None:
+                job = cls.jobs[job_id] = cls(settings)
+            job.refs += 1
+            return job
+
+    # Returns True if the caller was the last module of the job, the state is then forgotten
+    @classmethod
+    def release(cls, job_id):
+        with cls.jobs_lock:
+            job = cls.jobs[job_id]
+            job.refs -= 1
+            if job.refs:
+                return False
+            del cls.jobs[job_id]
+            return True
+
+    # Counts a file of the job, processed or unchanged since the last run
+    def count_file(self):
+        with self.lock:
+            self.files += 1
+
+    # Posts the buffered artifacts and saves the index, once all the files of the job are done
+    def close(self):
+        self.writer.flush()
+        self.index.save()
+        self.stats.add("blackboard", self.writer.seconds, self.writer.artifacts)
+
+
+# Cache of the custom artifact and attribute types used by the module.
+# Types are looked up in the case DB on first use only, every later request is served from memory.
+# Hit/miss counters allow to check how many DB round trips were actually made during the job.
+class MiHomeTypeRegistry(object):
+
+    def __init__(self, blackboard):
+        self.blackboard = blackboard
+        self.artifact_types = {}
+        self.attribute_types = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the type ID of the given artifact type, adding it to the case if needed
+    def artifact_type(self, type_name, display_name):
+        with self.lock:
+            type_id = self.artifact_types.get(type_name)
+            if type_id is None:
+                self.misses += 1
+                type_id = self.blackboard.getOrAddArtifactType(type_name, display_name).getTypeID()
+                self.artifact_types[type_name] = type_id
+            else:
+                self.hits += 1
+            return type_id
+
+    # Returns the given attribute type, adding it to the case if needed
+    def attribute_type(self, type_name, value_type, display_name):
+        with self.lock:
+            attribute_type = self.attribute_types.get(type_name)
+            if attribute_type is None:
+                self.misses += 1
+                attribute_type = self.blackboard.getOrAddAttributeType(type_name, value_type, display_name)
+                self.attribute_types[type_name] = attribute_type
+            else:
+                self.hits += 1
+            return attribute_type
+
+    def __str__(self):
+        return "MiHome Type Registry - {} artifact types, {} attribute types, Hits = {}, Misses = {}".format(
+            len(self.artifact_types), len(self.attribute_types), self.hits, self.misses)
+
+
+# Leading timestamp of a Log_Normal payload, [timestamp, [events...]]
+_payload_head = re.compile(r'\s*\[\s*(\d+)\s*,\s*')
+
+
+# Bounded LRU cache of the decoded events of Log_Normal payloads, and pool of the event and device strings.
+# Motion and door sensors log the same events over and over, each time with a new timestamp: the timestamp is
+# read from the text and only the events that follow it are cached, keyed by their text, so that a repeated
+# list is decoded once. Identical strings share a single instance. One instance is used per file, by the thread
+# parsing it. Cached values are shared between hits and must not be modified.
+class MiHomeDecodeCache(object):
+
+    def __init__(self, size, max_strings):
+        self.size = size
+        self.max_strings = max_strings
+        self.values = OrderedDict()
+        self.strings = {}
+        self.hits = 0
+        self.misses = 0
+        self.string_hits = 0
+        self.string_misses = 0
+
+    # Returns the (timestamp, events) of a payload
+    def decode(self, text):
+        head = _payload_head.match(text)
+        end = text.rfind("]")
+        if head is None or end < head.end():
+            # Not the usual layout, decoded as a whole
+            value = json.loads(text)
+            return value[0], value[1]
+        events = text[head.end():end]
+        value = self.values.pop(events, None)
+        if value is None:
+            self.misses += 1
+            try:
+                value = json.loads(events)
+            except ValueError:
+                # More than the events after the timestamp
+                value = json.loads(text)
+                return value[0], value[1]
+            if len(self.values) >= self.size:
+                # Least recently used first
+                self.values.popitem(last=False)
+        else:
+            self.hits += 1
+        self.values[events] = value
+        return long(head.group(1)), value
+
+    # Returns the shared instance of a string, the pool stops growing once full
+    def intern(self, string):
+        shared = self.strings.get(string)
+        if shared is not None:
+            self.string_hits += 1
+            return shared
+        self.string_misses += 1
+        if len(self.strings) < self.max_strings:
+            self.strings[string] = string
+        return string
+
+
+# Read-only, file-like view over the content of an AbstractFile, as expected by ET.parse.
+# Data is read through a ReadContentInputStream with a fixed size buffer, the file is never exported.
+class MiHomeContentStream(object):
+
+    def __init__(self, file, buffer_size):
+        self.stream = ReadContentInputStream(file)
+        self.buffer = jarray.zeros(buffer_size, "b")
+        self.bytes_read = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = clock()
+        chunks = []
+        remaining = size
+        while remaining != 0:
+            length = len(self.buffer) if remaining < 0 else min(remaining, len(self.buffer))
+            count = self.stream.read(self.buffer, 0, length)
+            if count <= 0:
+                break
+            chunks.append(self.buffer[:count].tostring())
+            self.bytes_read += count
+            if remaining > 0:
+                remaining -= count
+        self.seconds += clock() - start
+        return "".join(chunks)
+
+    def close(self):
+        self.stream.close()
+
+
+# Buffers the artifacts produced by the parsers and writes them to the blackboard in batches.
+# A single postArtifacts call per batch replaces one transaction and one event broadcast per artifact.
+# The buffer must be flushed at file boundaries and before returning from process, on cancel too.
+class MiHomeArtifactWriter(object):
+    _logger = Logger.getLogger(MiHomeIngestModuleFactory.moduleName)
+
+    def __init__(self, blackboard, batch_size):
+        self.blackboard = blackboard
+        self.batch_size = max(1, batch_size)
+        self.lock = threading.Lock()
+        # Held while a batch is created and posted
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        # Keys of the records whose artifact could not be created, by file object ID
+        self.lost = {}
+        self.artifacts = 0
+        self.batches = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    # 'key' is the key of the record in the MiHomeIngestIndex, handed back by flush if the artifact is lost
+    def add(self, file, art_type_id, attributes, key=None):
+        with self.lock:
+            self.pending.append((file, art_type_id, attributes, key))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    # Creates the buffered artifacts and posts them with a single call.
+    # The buffer is swapped under the lock, other threads keep adding while a batch is posted. Batches are posted
+    # one at a time: once flush returns, the artifacts added before the call, by any thread, are all posted.
+    # Returns the keys of the records of 'file' whose artifact could not be created since the file was last
+    # flushed, in this batch or in the ones posted when the buffer was full: the file is not complete if any.
+    def flush(self, file=None):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                self.post(pending)
+        if file is None:
+            return []
+        with self.lock:
+            return self.lost.pop(file.getId(), [])
+
+    # Creates the artifacts of a batch, records the ones lost, and posts the others
+    def post(self, pending):
+        start = clock()
+        errors = 0
+        artifacts = ArrayList()
+        for file, art_type_id, attributes, key in pending:
+            try:
+                artifact = file.newArtifact(art_type_id)
+                artifact.addAttributes(attributes)
+                artifacts.add(artifact)
+            except Exception as e:
+                errors += 1
+                with self.lock:
+                    self.lost.setdefault(file.getId(), []).append(key)
+                self._logger.logp(Level.SEVERE, self.__class__.__name__, "post",
+                                  "Error while creating artifact for file: " + file.getName() + " - " + str(e))
+
+        if not artifacts.isEmpty():
+            try:
+                self.blackboard.postArtifacts(artifacts, MiHomeIngestModuleFactory.moduleName)
+            except Exception as e:
+                # Artifacts are already in the case DB, only indexing and notification failed
+                errors += 1
+                self._logger.logp(Level.SEVERE, self.__class__.__name__, "post",
+                                  "Error while posting " + str(artifacts.size()) + " artifacts - " + str(e))
+
+        with self.lock:
+            if not artifacts.isEmpty():
+                self.artifacts += artifacts.size()
+                self.batches += 1
+            self.errors += errors
+            self.seconds += clock() - start
+
+    def __str__(self):
+        return "MiHome Artifact Writer - Artifacts = {}, Batches = {}, Errors = {}".format(
+            self.artifacts, self.batches, self.errors)
+
+
+# Pool of worker threads reading and decoding files ahead of the ingest thread.
+# Every file gets its own bounded queue of record chunks and files are handed back in their original order,
+# so that artifacts are still written by a single thread and in the same order as a sequential run.
+# Workers stop as soon as the job is cancelled or the pool is shut down.
+class MiHomeParserPool(object):
+    _logger = Logger.getLogger(MiHomeIngestModuleFactory.moduleName)
+
+    # Records handed over at once, and chunks queued at most per file
+    chunk_size = 256
+    queue_size = 16
+    # Seconds between two cancellation checks while waiting on a queue
+    poll_interval = 0.2
+    # Seconds shutdown waits for the workers to stop. They check for it between two records, only a single
+    # value taking longer than that to decode can keep one running, it is then logged and left to finish.
+    shutdown_timeout = 30
+
+    def __init__(self, num_workers, is_cancelled):
+        self.num_workers = num_workers
+        self.is_cancelled = is_cancelled
+        self.stopped = threading.Event()
+        self.threads = []
+
+    # Yields (file, records iterator) pairs in the order of the jobs, a job being a (file, read function) pair
+    def imap(self, jobs):
+        if self.num_workers <= 1:
+            for file, read in jobs:
+                yield file, read(file)
+            return
+
+        # Each job gets a queue for its records and a flag set once the ingest thread stops reading it
+        jobs = [(file, read, Queue.Queue(self.queue_size), threading.Event()) for file, read in jobs]
+        pending = Queue.Queue()
+        for job in jobs:
+            pending.put(job)
+
+        for i in range(min(self.num_workers, len(jobs))):
+            thread = threading.Thread(target=self.work, args=(pending,), name="MiHome Parser " + str(i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+        for file, read, chunks, abandoned in jobs:
+            yield file, self.drain(chunks, abandoned)
+
+    # Stops the workers and waits for them to exit
+    def shutdown(self):
+        self.stopped.set()
+        deadline = clock() + self.shutdown_timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - clock()))
+            if thread.isAlive():
+                self._logger.logp(Level.WARNING, self.__class__.__name__, "shutdown",
+                                  thread.getName() + " still running after " + str(self.shutdown_timeout) + "s")
+        self.threads = []
+
+    def is_stopped(self):
+        return self.stopped.isSet() or self.is_cancelled()
+
+    def work(self, pending):
+        while not self.is_stopped():
+            try:
+                file, read, chunks, abandoned = pending.get_nowait()
+            except Queue.Empty:
+                return
+            records = read(file)
+            chunk = []
+            try:
+                for record in records:
+                    if self.is_stopped():
+                        break
+                    chunk.append(record)
+                    if len(chunk) >= self.chunk_size:
+                        if not self.put(chunks, abandoned, chunk):
+                            break
+                        chunk = []
+                else:
+                    self.put(chunks, abandoned, chunk)
+                    self.put(chunks, abandoned, None)
+            except Exception as e:
+                self.put(chunks, abandoned, chunk)
+                self.put(chunks, abandoned, e)
+            finally:
+                records.close()
+
+    # Waits for room in the queue, giving up if the pool is stopped or the file abandoned meanwhile
+    def put(self, chunks, abandoned, item):
+        while not self.is_stopped() and not abandoned.isSet():
+            try:
+                chunks.put(item, True, self.poll_interval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    # Yields the records of a file as the worker produces them, errors raised by the worker are raised here
+    def drain(self, chunks, abandoned):
+        try:
+            while True:
+                try:
+                    item = chunks.get(True, self.poll_interval)
+                except Queue.Empty:
+                    if self.is_stopped():
+                        return
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                for record in item:
+                    yield record
+        finally:
+            abandoned.set()
+
+
+# Progress of the job in bytes of content, shown with the number of records of the current file and an estimate
+# of the time left. Files are parsed by the parser threads while the ingest thread writes their records: the
+# position in a file is the one reached by its MiHomeEntryContext. Only the ingest thread updates the progress
+# bar, at most once per update_interval seconds.
+class MiHomeProgress(object):
+    update_interval = 0.5
+
+    def __init__(self, progress_bar, total_bytes):
+        self.progress_bar = progress_bar
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.skipped_bytes = 0
+        self.parsing = {}
+        self.start = clock()
+        self.last_update = self.start
+        # Work units are KB, an int is not enough for bytes
+        progress_bar.switchToDeterminate(max(1, total_bytes // 1024))
+
+    # Called by the thread parsing a file
+    def reading(self, file, context):
+        self.parsing[file.getId()] = context
+
+    # Unchanged file, done without being read, left out of the estimate of the time left
+    def skip(self, file):
+        self.done_bytes += file.getSize()
+        self.skipped_bytes += file.getSize()
+        self.progress_bar.progress(self.done_bytes // 1024)
+
+    def finish(self, file):
+        self.parsing.pop(file.getId(), None)
+        self.done_bytes += file.getSize()
+        self.progress_bar.progress(self.done_bytes // 1024)
+
+    def update(self, file, records):
+        now = clock()
+        if now - self.last_update < self.update_interval:
+            return
+        self.last_update = now
+        context = self.parsing.get(file.getId())
+        position = self.done_bytes + (min(context.position(), file.getSize()) if context is not None else 0)
+        message = "{}: {} records, {:.1f} of {:.1f} MB".format(
+            file.getName(), records, position / 1048576.0, self.total_bytes / 1048576.0)
+        processed = position - self.skipped_bytes
+        if processed > 0:
+            seconds_left = int((self.total_bytes - position) * (now - self.start) / processed)
+            message += ", {}:{:02d} left".format(seconds_left // 60, seconds_left % 60)
+        self.progress_bar.progress(message, position // 1024)
+
+
+# Persistent, per-case index of the files processed by the module and of the artifacts posted for each one.
+# Stored in the module output directory: index.json maps each file object ID to the signature of its content
+# (size, mtime and MD5 when available), <object ID>.fp holds the 64-bit fingerprints of its posted records.
+# Unchanged files are skipped with a single lookup, changed files only post the records not seen before.
+# Files may be processed by several threads at once, each one tracks the records of its current file.
+# The jobs of the data sources of a case may run at the same time: each one only writes the entries of the files
+# it committed into index.json, merged with the ones saved meanwhile by the others.
+class MiHomeIngestIndex(object):
+    _logger = Logger.getLogger(MiHomeIngestModuleFactory.moduleName)
+    version = 1
+    # Held by the job saving index.json, shared by all the jobs of the process
+    save_lock = threading.Lock()
+
+    def __init__(self, directory, enabled):
+        self.directory = directory
+        self.enabled = enabled
+        self.files = {}
+        # Object IDs of the files committed by this job
+        self.committed = set()
+        self.current = threading.local()
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.duplicates = 0
+        if enabled:
+            self.load()
+
+    def load(self):
+        try:
+            self.files = self.read()
+        except Exception as e:
+            self._logger.logp(Level.WARNING, self.__class__.__name__, "load",
+                              "Error while loading index, all files will be processed - " + str(e))
+
+    # Returns the entries of the files stored in index.json, none if missing or of another version
+    def read(self):
+        index_path = os.path.join(self.directory, "index.json")
+        if not os.path.exists(index_path):
+            return {}
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+        if index.get("version") != self.version:
+            return {}
+        return index.get("files", {})
+
+    # Writes the entries of the files committed by this job over the current content of index.json.
+    # The new index is written to a temp file first and moved in place, it is never seen half written.
+    def save(self):
+        if not self.enabled or not self.committed:
+            return
+        with self.save_lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            try:
+                files = self.read()
+            except Exception as e:
+                self._logger.logp(Level.WARNING, self.__class__.__name__, "save",
+                                  "Error while reading index, only the files of this job are kept - " + str(e))
+                files = {}
+            with self.lock:
+                for file_id in self.committed:
+                    files[file_id] = self.files[file_id]
+            index_path = os.path.join(self.directory, "index.json")
+            with open(index_path + ".tmp", "w") as index_file:
+                json.dump({"version": self.version, "files": files}, index_file)
+            Files.move(Paths.get(index_path + ".tmp"), Paths.get(index_path),
+                       StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+
+    def is_known(self, file):
+        return self.enabled and str(file.getId()) in self.files
+
+    def is_unchanged(self, file):
+        if not self.enabled:
+            return False
+        entry = self.files.get(str(file.getId()))
+        unchanged = entry is not None and entry.get("complete") and entry.get("signature") == file_signature(file)
+        if unchanged:
+            with self.lock:
+                self.skipped += 1
+        return unchanged
+
+    # Starts tracking the records posted for a file, loading the ones posted by previous runs
+    def begin(self, file):
+        if not self.enabled:
+            return
+        self.current.posted = array.array("l")
+        self.current.known = set()
+        if self.is_known(file):
+            fingerprints = array.array("l")
+            fp_path = self.fingerprints_path(file)
+            if os.path.exists(fp_path):
+                with open(fp_path, "rb") as fp_file:
+                    fingerprints.fromstring(fp_file.read())
+            self.current.known.update(fingerprints)
+
+    # Returns the key of a record, its fingerprint, or None when the index is disabled
+    def key(self, record):
+        return record_fingerprint(record) if self.enabled else None
+
+    # Returns True if the record was already posted for the current file by a previous run, tracks it otherwise
+    def is_posted(self, fingerprint):
+        if fingerprint is None:
+            return False
+        if fingerprint in self.current.known:
+            with self.lock:
+                self.duplicates += 1
+            return True
+        self.current.posted.append(fingerprint)
+        return False
+
+    # Saves the records posted for the current file, the file is skipped next time only if complete.
+    # The 'lost' records, tracked but whose artifact could not be written, are left out to be posted next time.
+    def commit(self, file, complete, lost=()):
+        if not self.enabled:
+            return
+        with self.lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+        posted = self.current.posted
+        if lost:
+            lost = set(lost)
+            posted = array.array("l", [fingerprint for fingerprint in posted if fingerprint not in lost])
+        with open(self.fingerprints_path(file), "ab") as fp_file:
+            fp_file.write(posted.tostring())
+        with self.lock:
+            self.files[str(file.getId())] = {"signature": file_signature(file), "complete": complete}
+            self.committed.add(str(file.getId()))
+        self.current.known = None
+        self.current.posted = None
+
+    def fingerprints_path(self, file):
+        return os.path.join(self.directory, str(file.getId()) + ".fp")
+
+    def __str__(self):
+        return "MiHome Ingest Index - Files = {}, Skipped = {}, Already Posted = {}".format(
+            len(self.files), self.skipped, self.duplicates)
+
+
+# Set of the events posted during a job, used to drop the copies of an event found in overlapping Log_Normal
+# snapshots, in several config.xml files or in backups. Events are keyed on (device, type, timestamp, value),
+# with the timestamp as stored so that distinct events logged within the same second are all kept, by their
+# 64-bit fingerprint, stored in an open addressing table of longs (0 marks a free slot).
+# The table doubles when 3/4 full, up to the memory cap: past it, duplicates of the events already in the
+# table are still dropped, new events are posted but no longer remembered.
+class MiHomeEventFilter(object):
+    initial_slots = 4096
+    max_load = 0.75
+
+    def __init__(self, enabled, memory_mb):
+        self.enabled = enabled
+        self.max_slots = self.initial_slots
+        while self.max_slots * 2 * 8 <= memory_mb * 1024 * 1024:
+            self.max_slots *= 2
+        self.slots = array.array("l", [0]) * (self.initial_slots if enabled else 0)
+        self.mask = len(self.slots) - 1
+        self.limit = int(len(self.slots) * self.max_load)
+        self.lock = threading.Lock()
+        self.size = 0
+        self.events = 0
+        self.duplicates = 0
+        self.untracked = 0
+
+    # Returns True if the same event was already seen during the job, remembers it otherwise
+    def is_duplicate(self, event, ev_date, log_date, ev_type, ev_device, ev_raw, tz_offset=0):
+        if not self.enabled:
+            return False
+        fingerprint = record_fingerprint((ev_device, ev_type, ev_raw, event)) or 1
+        with self.lock:
+            self.events += 1
+            if self.size >= self.limit and not self.grow():
+                # Full, only look the event up
+                index = self.find(fingerprint)
+                if self.slots[index] == fingerprint:
+                    self.duplicates += 1
+                    return True
+                self.untracked += 1
+                return False
+            index = self.find(fingerprint)
+            if self.slots[index] == fingerprint:
+                self.duplicates += 1
+                return True
+            self.slots[index] = fingerprint
+            self.size += 1
+            return False
+
+    # Index of the slot holding the fingerprint, or of the free slot where it goes
+    def find(self, fingerprint):
+        slots = self.slots
+        mask = self.mask
+        index = fingerprint & mask
+        while slots[index] and slots[index] != fingerprint:
+            index = (index + 1) & mask
+        return index
+
+    def grow(self):
+        if len(self.slots) >= self.max_slots:
+            return False
+        old_slots = self.slots
+        self.slots = array.array("l", [0]) * (len(old_slots) * 2)
+        self.mask = len(self.slots) - 1
+        self.limit = int(len(self.slots) * self.max_load)
+        for fingerprint in old_slots:
+            if fingerprint:
+                self.slots[self.find(fingerprint)] = fingerprint
+        return True
+
+    def summary(self):
+        return "Duplicate events dropped: {} of {}".format(self.duplicates, self.events)
+
+    def __str__(self):
+        return "MiHome Event Filter - Events = {}, Duplicates = {}, Tracked = {}, Untracked = {}, Table = {} KB".format(
+            self.events, self.duplicates, self.size, self.untracked, len(self.slots) * self.slots.itemsize // 1024)
+
+
+# Signature of the content of a file, used to detect changes between runs
+def file_signature(file):
+    return [file.getSize(), file.getMtime(), file.getMd5Hash()]
+
+
+# Compact 64-bit fingerprint of a record
+def record_fingerprint(record):
+    digest = hashlib.md5(u"\x1f".join(unicode(value) for value in record).encode("utf-8")).digest()
+    return struct.unpack("<q", digest[:8])[0]
+
+
+# Tells if a config.xml file belongs to MiHome, from its path or from the keys found at its start
+def is_mihome_config(file):
+    if MIHOME_PACKAGE in file.getParentPath():
+        return True
+    try:
+        buffer = jarray.zeros(min(SNIFF_SIZE, file.getSize()), "b")
+        count = file.read(buffer, 0, len(buffer))
+    except Exception:
+        # Unreadable, let the parser report it
+        return True
+    head = buffer[:count].tostring()
+    for marker in SNIFF_MARKERS:
+        if marker in head:
+            return True
+    return False
+
+
+# Yields the records stored in a miio.db file, reading every table with a forward-only cursor.
+def iter_db_table_records(connection, fetch_size, timestamps):
+    for table, columns in iter_db_tables(connection):
+        if all(column in columns for column in DB_DEVICE_KEYS):
+            query = db_select(table, columns, DB_DEVICE_COLUMNS)
+            for row in iter_db_rows(connection, query, len(DB_DEVICE_COLUMNS), fetch_size):
+                did, name, model, mac, ip, ssid, latitude, longitude = row
+                yield (RECORD_DB_DEVICE, did, name, model, mac, ip, ssid, latitude, longitude)
+
+        elif all(column in columns for column in DB_LOG_KEYS):
+            query = db_select(table, columns, DB_LOG_COLUMNS)
+            for row in iter_db_rows(connection, query, len(DB_LOG_COLUMNS), fetch_size):
+                did, time, ev_type, key, value = row
+                if time is None or value is None:
+                    continue
+                try:
+                    raw_ts = long(time)
+                except ValueError:
+                    continue
+                ts = timestamps.normalise(raw_ts)
+                yield (RECORD_EVENT, value, ts, ts, ev_type or key, did, raw_ts)
+
+
+# Yields the name and the lower case column names of each table in the DB
+def iter_db_tables(connection):
+    tables = [row[0] for row in iter_db_rows(connection, "SELECT name FROM sqlite_master WHERE type = 'table'", 1, 0)]
+    for table in tables:
+        columns = set()
+        for row in iter_db_rows(connection, "PRAGMA table_info(\"%s\")" % table.replace('"', '""'), 2, 0):
+            columns.add(row[1].lower())
+        yield table, columns
+
+
+# Builds a query returning the requested columns, NULL is selected for the ones missing from the table
+def db_select(table, columns, wanted):
+    fields = ['"%s"' % column if column in columns else "NULL" for column in wanted]
+    return "SELECT %s FROM \"%s\"" % (", ".join(fields), table.replace('"', '""'))
+
+
+# Yields the rows of a query as tuples of strings, without materialising the result set
+def iter_db_rows(connection, query, num_columns, fetch_size):
+    statement = connection.createStatement(ResultSet.TYPE_FORWARD_ONLY, ResultSet.CONCUR_READ_ONLY)
     try:
-        if datetime.fromtimestamp(timestamp) > boundary:
-            # Provided timestamp is in millis or nanos, reduce
-            return(ts_uniform_to_seconds(timestamp/1000))
+        if fetch_size:
+            statement.setFetchSize(fetch_size)
+        result_set = statement.executeQuery(query)
+        try:
+            while result_set.next():
+                yield tuple(result_set.getString(i) for i in range(1, num_columns + 1))
+        finally:
+            result_set.close()
+    finally:
+        statement.close()
+
+
+# Yields the direct children of the root element of an XML document.
+# In streaming mode the document is read incrementally with iterparse and every child is discarded
+# once consumed, so that only one entry at a time is kept in memory instead of the whole tree.
+def iter_xml_entries(source, streaming):
+    if not streaming:
+        for child in ET.parse(source).getroot():
+            yield child
+        return
+
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
         else:
-            return(timestamp)
-    except ValueError:
-        return(ts_uniform_to_seconds(timestamp/1000))
+            depth -= 1
+            if depth == 1:
+                yield elem
+                root.clear()
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r"[ \t\n\r]*")
+
+
+# Yields the elements of a JSON array.
+# In streaming mode elements are decoded one at a time, the full decoded list never exists, and the index in the
+# text of the next element is kept in cursor[0] if a cursor list is given.
+def json_array(text, streaming, cursor=None):
+    if not streaming:
+        return iter(json.loads(text))
+    return iter_json_array(text, 0, cursor)
+
+
+# Yields the elements of the JSON array stored under the given key of a JSON object.
+# Nothing is yielded if the key is missing.
+def json_member_array(text, key, streaming, cursor=None):
+    if not streaming:
+        return iter(json.loads(text).get(key) or [])
+    return iter_json_member_array(text, key, cursor)
+
+
+def iter_json_array(text, idx, cursor=None):
+    idx = _json_whitespace.match(text, idx).end()
+    if text[idx:idx + 1] != "[":
+        raise ValueError("Expecting JSON array at position {}".format(idx))
+    idx = _json_whitespace.match(text, idx + 1).end()
+    if text[idx:idx + 1] == "]":
+        return
+    while True:
+        value, idx = _json_decoder.raw_decode(text, idx)
+        if cursor is not None:
+            cursor[0] = idx
+        yield value
+        idx = _json_whitespace.match(text, idx).end()
+        separator = text[idx:idx + 1]
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Expecting ',' delimiter at position {}".format(idx))
+        idx = _json_whitespace.match(text, idx + 1).end()
+
+
+def iter_json_member_array(text, key, cursor=None):
+    idx = _json_whitespace.match(text, 0).end()
+    if text[idx:idx + 1] != "{":
+        raise ValueError("Expecting JSON object at position {}".format(idx))
+    idx = _json_whitespace.match(text, idx + 1).end()
+    if text[idx:idx + 1] == "}":
+        return
+    while True:
+        name, idx = _json_decoder.raw_decode(text, idx)
+        idx = _json_whitespace.match(text, idx).end()
+        if text[idx:idx + 1] != ":":
+            raise ValueError("Expecting ':' delimiter at position {}".format(idx))
+        idx = _json_whitespace.match(text, idx + 1).end()
+        if name == key and text[idx:idx + 1] == "[":
+            for value in iter_json_array(text, idx, cursor):
+                yield value
+            return
+        value, idx = _json_decoder.raw_decode(text, idx)
+        if name == key:
+            # Not an array, same result as iterating over a missing key
+            return
+        idx = _json_whitespace.match(text, idx).end()
+        separator = text[idx:idx + 1]
+        if separator == "}":
+            return
+        if separator != ",":
+            raise ValueError("Expecting ',' delimiter at position {}".format(idx))
+        idx = _json_whitespace.match(text, idx + 1).end()
+
+
+# State of the parsing of a file, handed to the entry parsers. One instance per file.
+class MiHomeEntryContext(object):
+
+    def __init__(self, module, streaming):
+        self.module = module
+        self.streaming = streaming
+        self.debug = module._logger.isLoggable(Level.FINEST)
+        self.timestamps = module.timestamps
+        self.stats = MiHomeStats()
+        self.cache = MiHomeDecodeCache(PAYLOAD_CACHE_SIZE, STRING_POOL_SIZE)
+        self.stream = None
+        # Bytes read when the current entry started, its length, and [index, length] in the JSON text iterated
+        self.entry_start = 0
+        self.entry_length = 0
+        self.cursor = [0, 0]
+
+    def enter(self, text):
+        self.entry_length = len(text or "")
+        # The XML parser reads ahead by less than a buffer, good enough for a progress bar
+        self.entry_start = max(0, self.stream.bytes_read - self.entry_length) if self.stream is not None else 0
+        self.cursor[1] = 0
+
+    # Returns the cursor to pass to the JSON helpers for a text making up the whole entry
+    def track(self, text):
+        self.cursor[0] = 0
+        self.cursor[1] = len(text)
+        return self.cursor
+
+    # Approximate number of bytes of the file parsed so far, called from the ingest thread
+    def position(self):
+        index, length = self.cursor
+        if length:
+            return self.entry_start + self.entry_length * min(index, length) // length
+        return self.stream.bytes_read if self.stream is not None else 0
+
+
+# Parsers of SharedPreferences entries and their name patterns, by group name in ENTRY_NAME_PATTERN.
+# The patterns of all the parsers are combined in a single regex, compiled once at module load: an entry is
+# routed with one search on its name, however many parsers are registered.
+ENTRY_PATTERNS = OrderedDict()
+ENTRY_PARSERS = {}
+ENTRY_NAME_PATTERN = None
+
+
+# Registers a generator function as the parser of the entries whose name matches the pattern.
+# It is called with the MiHomeEntryContext of the file, the text of the entry and the match of the pattern on
+# the entry name, and yields (RECORD_* type, add_* arguments...) tuples. Patterns are searched anywhere in the
+# name, their own groups must have names unique across parsers.
+def entry_parser(pattern):
+    def register(parser):
+        global ENTRY_NAME_PATTERN
+        ENTRY_PATTERNS[parser.__name__] = pattern
+        ENTRY_PARSERS[parser.__name__] = parser
+        ENTRY_NAME_PATTERN = re.compile("|".join("(?P<{}>{})".format(name, entry_pattern)
+                                                 for name, entry_pattern in ENTRY_PATTERNS.items()))
+        return parser
+    return register
+
+
+# HTMLParser.unescape keeps no state, a single instance is shared by all the threads
+html_unescape = HTMLParser.HTMLParser().unescape
+
+
+# Log_Normal logs, flat JSON objects, and the timestamps of their payloads, escaped in the value of the log.
+# Timestamps of the ht_stat readings, or of a log. All of them are read from the text, before anything is
+# decoded, to detect the timezone shift of an entry as a whole.
+_log_object = re.compile(r'\{[^{}"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^{}"]*)*\}')
+_payload_time = re.compile(r'[\[,]\s*\\"\[\s*(\d+)')
+_reading_time = re.compile(r'"time"\s*:\s*(\d+)')
+
+
+# Returns the record of an event. 'raw_ts' is its timestamp as stored, before it is normalised to seconds,
+# corrected ones also carry the offset applied to their timestamp.
+def event_record(event, ev_ts, log_ts, ev_type, device, raw_ts, offset):
+    if offset:
+        return (RECORD_EVENT, event, ev_ts, log_ts, ev_type, device, raw_ts, offset)
+    return (RECORD_EVENT, event, ev_ts, log_ts, ev_type, device, raw_ts)
+
+
+# Event logs of motion/door sensors
+@entry_parser(r"Log_Normal")
+def parse_log_normal(context, text, match):
+    stats = context.stats
+    cache = context.cache
+    timestamps = context.timestamps
+
+    # First pass over the text of the logs, only for the gap between their payloads and themselves
+    offset = 0
+    if timestamps.fix_timezone:
+        start = clock()
+        delta = None
+        samples = 0
+        for count, log in enumerate(_log_object.finditer(text), 1):
+            log_time = _reading_time.search(text, log.start(), log.end())
+            latest, payloads = timestamps.scan(_payload_time, text, log.start(), log.end())
+            if payloads and log_time is not None:
+                gap = latest - timestamps.normalise(long(log_time.group(1)))
+                delta = gap if delta is None else max(delta, gap)
+                samples += payloads
+            if count % PROGRESS_INTERVAL == 0 and context.module.context.isJobCancelled():
+                return
+        offset = timestamps.detect_offset(delta, samples)
+        stats.add("timestamps", clock() - start, samples)
+
+    logs = json_member_array(text, "value", context.streaming, context.track(text))
+    for log in stats.timed("json_decode", logs):
+        device = cache.intern(log.get("did"))
+        ev_type = cache.intern(log.get("type"))
+        start = clock()
+        payloads = [cache.decode(payload) for payload in json_array(log.get("value", "[]"), context.streaming)]
+        stats.add("json_decode", clock() - start, len(payloads))
+        start = clock()
+        log_ts = timestamps.normalise(log.get("time"))
+        ev_timestamps = timestamps.normalise_batch([payload[0] for payload in payloads], offset)
+        stats.add("timestamps", clock() - start, len(payloads) + 1)
+        for payload, ev_ts in zip(payloads, ev_timestamps):
+            for item in payload[1]:
+                if item:
+                    yield event_record(cache.intern(item), ev_ts, log_ts, ev_type, device, payload[0], offset)
+
+
+# Readings of temperature/humidity sensors, the entry is named after the device
+@entry_parser(r"_ht_stat")
+def parse_ht_stat(context, text, match):
+    stats = context.stats
+    timestamps = context.timestamps
+    device = match.string[:match.start()]
+    start = clock()
+    data = json.loads(text)
+    stats.add("json_decode", clock() - start)
+    log_ts = timestamps.normalise(data.get("time"))
+    value = data.get("value", "[]")
+
+    # All the readings are checked against the time of the entry at once, from the latest of them
+    offset = 0
+    if timestamps.fix_timezone and log_ts is not None:
+        start = clock()
+        latest, count = timestamps.scan(_reading_time, value)
+        offset = timestamps.detect_offset(latest - log_ts if count else None, count)
+        stats.add("timestamps", clock() - start, count)
+
+    values = stats.timed("json_decode", json_array(value, context.streaming, context.track(value)))
+    for logs in iter_batches(values, TIMESTAMP_BATCH_SIZE):
+        start = clock()
+        ev_timestamps = timestamps.normalise_batch([log.get("time") for log in logs], offset)
+        stats.add("timestamps", clock() - start, len(logs))
+        for log, ev_ts in zip(logs, ev_timestamps):
+            for event, value in log.items():
+                if event != "time":
+                    if context.debug:
+                        context.module.log(Level.FINEST, "Event Type: " + event + ", Event Value: " + value)
+                    yield event_record(value, ev_ts, log_ts, event, device, log.get("time"), offset)
+
+
+# Last readings of the environment sensors
+@entry_parser(r"env_data")
+def parse_env_data(context, text, match):
+    env_data = html_unescape(text)
+    for item in context.stats.timed("json_decode", json_member_array(env_data, "description_list", context.streaming)):
+        device = item.get("did")
+        for detail in item.get("details", []):
+            ev_type = detail.get("prop")
+            ev_ts = detail.get("timestamp")
+            event = detail.get("description")
+            yield (RECORD_EVENT, event, ev_ts, ev_ts, ev_type, device, ev_ts)
+
+
+# Homes, with their rooms and the devices in each room
+@entry_parser(r"home_room_content")
+def parse_home_room_content(context, text, match):
+    home_data = html_unescape(text)
+    for home in context.stats.timed("json_decode", json_member_array(home_data, "homelist", context.streaming)):
+        home_name = home.get("name")
+        home_id = home.get("id")
+        home_address = home.get("address")
+        home_latitude = str(home.get("latitude"))
+        home_longitude = str(home.get("longitude"))
+        yield (RECORD_HOME, home_name, home_id, home_address, home_latitude, home_longitude)
+        for room in home.get("roomlist", []):
+            room_name = room.get("name")
+            room_id = room.get("id")
+            for device in room.get("dids", []):
+                if context.debug:
+                    context.module.log(Level.FINEST, "Device: " + device)
+                yield (RECORD_DEVICE, room_name, room_id, home_id, device)
+
+
+# Monotonic clock, in seconds
+def clock():
+    return System.nanoTime() / 1000000000.0
+
+
+# Time spent and number of items processed in each stage of the ingest job.
+# Each file is measured in its own instance, merged into the one of the job once done, so that the parser
+# threads never contend on a lock while measuring.
+class MiHomeStats(object):
+    # Stages and the unit of their counts
+    stages = (("discovery", "files"), ("extraction", "bytes"), ("xml_parse", "entries"), ("json_decode", "values"),
+              ("db_query", "rows"), ("timestamps", "timestamps"), ("blackboard", "artifacts"))
+    # Caches whose hit rate is reported
+    caches = ("payload_cache", "string_pool")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = dict((stage, 0.0) for stage, unit in self.stages)
+        self.counts = dict((stage, 0) for stage, unit in self.stages)
+        self.hits = dict((cache, 0) for cache in self.caches)
+        self.misses = dict((cache, 0) for cache in self.caches)
+
+    def add(self, stage, seconds, count=1):
+        self.seconds[stage] += seconds
+        self.counts[stage] += count
+
+    # Yields the items of an iterable, adding the time spent producing each of them to the stage
+    def timed(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds[stage] += clock() - start
+                return
+            self.add(stage, clock() - start)
+            yield item
+
+    def add_cache(self, cache, hits, misses):
+        self.hits[cache] += hits
+        self.misses[cache] += misses
+
+    def merge(self, other):
+        with self.lock:
+            for stage, unit in self.stages:
+                self.seconds[stage] += other.seconds[stage]
+                self.counts[stage] += other.counts[stage]
+            for cache in self.caches:
+                self.hits[cache] += other.hits[cache]
+                self.misses[cache] += other.misses[cache]
+
+    # One line per stage, stages run by the parser threads overlap and may add up to more than the job time.
+    # Followed by one line per cache used.
+    def summary(self):
+        lines = ["{}: {:.3f}s, {} {}".format(stage, self.seconds[stage], self.counts[stage], unit)
+                 for stage, unit in self.stages if self.counts[stage] or self.seconds[stage]]
+        for cache in self.caches:
+            lookups = self.hits[cache] + self.misses[cache]
+            if lookups:
+                lines.append("{}: {:.1f}% hits, {} lookups".format(cache, 100.0 * self.hits[cache] / lookups, lookups))
+        return lines
+
+    def __str__(self):
+        return "MiHome Stage Timings - " + ", ".join(self.summary())
+
+
+# Yields the items of an iterable in lists of at most size items
+def iter_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Converts the timestamps found in the logs, in seconds, millis, micros or nanos, to seconds.
+# The resolution is found from the magnitude of the value: anything later than tomorrow is taken as the
+# next finer resolution. The boundaries are computed once, so that normalising is a handful of comparisons.
+# Batches of event timestamps are also checked against the timestamp of their log to detect the timezone
+# shifted timestamps stored by some devices (see README, Known Issues): events cannot be logged before they
+# happen, an entry whose latest event is after its log by a whole timezone offset is shifted back as a whole.
+class MiHomeTimestampNormaliser(object):
+    # Units per second of the supported resolutions, from the coarsest
+    scales = (1, 1000, 1000000, 1000000000)
+    # Timezone offsets are multiples of 15 minutes, up to UTC+14
+    tz_step = 15 * 60
+    tz_max = 14 * 3600
+    # Clock skew allowed between the events and their log, and longest delay expected between the latest
+    # event and its log for a shift to be recognised
+    tz_tolerance = 60
+    tz_max_lag = 5 * 60
+    # Smallest entry checked for a shift
+    tz_min_samples = 3
+
+    def __init__(self, fix_timezone):
+        self.fix_timezone = fix_timezone
+        boundary = long(mktime((datetime.now() + timedelta(1)).timetuple()))  # Boundary is today + 1 day
+        self.boundaries = tuple((boundary * scale, scale) for scale in self.scales)
+        self.lock = threading.Lock()
+        self.offsets = {}
+        self.corrected = 0
+
+    def normalise(self, timestamp):
+        for boundary, scale in self.boundaries:
+            if timestamp <= boundary:
+                return timestamp if scale == 1 else timestamp / scale
+        # Finer than nanos, reduce and start over
+        return self.normalise(timestamp / self.scales[-1])
+
+    # Normalises a batch of event timestamps, shifting them back by the timezone offset detected for their entry
+    def normalise_batch(self, timestamps, offset=0):
+        timestamps = [self.normalise(timestamp) for timestamp in timestamps]
+        if not offset:
+            return timestamps
+        with self.lock:
+            self.corrected += len(timestamps)
+        return [timestamp - offset if timestamp is not None else None for timestamp in timestamps]
+
+    # Returns the timezone offset, in seconds, by which the events of an entry are ahead of their logs, 0 if none.
+    # 'delta' is the largest difference between an event and its log over the whole entry and 'samples' the number
+    # of events, so that every event of a shifted entry gets the same correction, however old.
+    def detect_offset(self, delta, samples):
+        if not self.fix_timezone or delta is None or samples < self.tz_min_samples:
+            return 0
+        if delta <= self.tz_tolerance or delta > self.tz_max + self.tz_tolerance:
+            return 0
+        # Smallest whole offset putting the latest event back before its log
+        offset = -(-long(delta - self.tz_tolerance) // self.tz_step) * self.tz_step
+        if offset - delta > self.tz_max_lag:
+            # Too far from a whole offset to be a timezone shift
+            return 0
+        with self.lock:
+            self.offsets[offset] = self.offsets.get(offset, 0) + 1
+        return offset
+
+    # Returns the latest of the timestamps captured by the pattern in a text, or in text[pos:endpos], normalised,
+    # and their number. Used to detect the shift of an entry without decoding its values.
+    def scan(self, pattern, text, pos=0, endpos=None):
+        timestamps = [long(timestamp) for timestamp in pattern.findall(text, pos, len(text) if endpos is None else endpos)]
+        if not timestamps:
+            return None, 0
+        latest = max(timestamps)
+        # Timestamps of the same resolution keep their order once normalised, only mixed ones are all normalised
+        if self.scale(min(timestamps)) != self.scale(latest):
+            return max(self.normalise(timestamp) for timestamp in timestamps), len(timestamps)
+        return self.normalise(latest), len(timestamps)
+
+    # Units per second of a timestamp, None if finer than nanos
+    def scale(self, timestamp):
+        for boundary, scale in self.boundaries:
+            if timestamp <= boundary:
+                return scale
+        return None
+
+    def __str__(self):
+        offsets = ", ".join("{:+.2f}h x {}".format(offset / 3600.0, count) for offset, count in sorted(self.offsets.items()))
+        return "MiHome Timestamps - Timezone Fix = {}, Corrected Events = {}, Shifted Entries = [{}]".format(
+            self.fix_timezone, self.corrected, offsets)